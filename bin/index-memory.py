@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# memory held by the DBIndexes of a tinydb Packet-like table, per record
+#
+# builds a table of -n packets, opens the unrestricted range on the time
+# stamp and one range per node, as the console does, and reports the memory
+# allocated by them, with tracemalloc
+#
+#   python3 bin/index-memory.py -n 100000 -s 20
+#
+# the numbers to compare with are from 33a1966, the commit before DBIndexes hold
+# only keys; it has the insert_many and lazy_tables this script needs, the
+# baseline does not. With -n 100000 -s 20 it gives about 640 bytes/packet there
+# and about 16.5 here:
+#
+#   git worktree add /tmp/before 33a1966
+#   cp bin/index-memory.py /tmp/before/bin/
+#   python3 /tmp/before/bin/index-memory.py -n 100000 -s 20
+
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steamlink.db import DB
+from steamlink.linkage import CSearchKey
+
+
+def csk(restrict_by):
+	return CSearchKey('Packet', 'ts', None, 0, 1, restrict_by=restrict_by)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="DBIndex memory per record")
+	parser.add_argument("-n", "--records", type=int, default=100000, help="packets in the table")
+	parser.add_argument("-s", "--nodes", type=int, default=20, help="nodes, one restricted index each")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		db = DB({'backend': 'tinydb', 'db_filename': os.path.join(tmpdir, 'steamlink.db'), 'lazy_tables': []}, None)
+		asyncio.get_event_loop().run_until_complete(db.start())
+		table = db.table('Packet', 'ts')
+		table.insert_many([{'ts': float(i), 'slid': i % args.nodes, 'rssi': -50, 'payload': 'p%d' % i}
+						   for i in range(args.records)])
+
+		gc.collect()
+		tracemalloc.start()
+		t = time.time()
+		list(table.get_range(csk([])))
+		for slid in range(args.nodes):
+			list(table.get_range(csk([{'field_name': 'slid', 'op': '==', 'value': slid}])))
+		elapsed = time.time() - t
+		gc.collect()
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+
+		print("%s packets, %s indexes, built in %.2fs" % (args.records, len(table.restrict_idxs), elapsed))
+		print("%.1f bytes/packet, %.1f MB" % (size / args.records, size / 1e6))
+		db.close()
+
+
+if __name__ == '__main__':
+	main()
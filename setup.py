@@ -26,7 +26,8 @@ REQUIRES = [
 	'tinydb>=3.9.0',
 	'tinydb-smartcache>=1.0.2',
 	'zeroconf>=0.20.0',
-	'msgpack>=0.5.6'
+	'msgpack>=0.5.6',
+	'sortedcontainers>=2.0.0'
 ]
 
 setup(
@@ -0,0 +1,266 @@
+# python library Steamlink
+
+import bisect
+import json
+import logging
+import mmap
+import os
+from array import array
+from collections import OrderedDict
+
+from . import (DBG, DBGK)
+
+logger = logging.getLogger()
+
+
+#
+# ColumnArchive
+#
+class ColumnArchive:
+	""" append-only columnar store for records ordered by time stamp
+		- each column is a file of one typed array, the first column is the
+		  time stamp, time ranges are found by bisection on it
+		- side fields, e.g. payloads, are json lines with an offsets column
+		- files are read through mmap, a column is a memoryview of its file,
+		  so opening an archive reads nothing and a range read only faults in
+		  the pages of the range
+		- select() returns the columns of a time range as zero-copy memoryview
+		  slices, without creating a dict per record
+		- columns are appended side fields first and time stamp last, open()
+		  truncates a partial append after a crash
+		- before() and after() return the records of a page next to a time
+		  stamp as dicts, for DbBackedTable.get_range, so cursor pages of the
+		  web console continue from the table into the archive
+	"""
+	PAGE_RECORDS = 256  # records decoded at a time by before() and after()
+
+
+	def __init__(self, dirname, columns, side=(), encode=None, decode=None):
+		""" columns is a list of (field, array typecode), side a list of fields,
+			encode maps a field to a function that makes its value numeric,
+			decode to the inverse
+		"""
+		self.dirname = dirname
+		self.columns = OrderedDict(columns)
+		self.ts_field = columns[0][0]
+		self.side = list(side)
+		self.encode = encode if encode is not None else {}
+		self.decode = decode if decode is not None else {}
+		self.views = {}  # field -> memoryview of the mapped column file
+		self.side_map = None
+		self.open()
+
+
+	def col_path(self, field):
+		return os.path.join(self.dirname, field + '.col')
+
+
+	def view(self, field):
+		""" the column as a memoryview of its file, mapped on first use """
+		if field not in self.views:
+			typecode = 'q' if field == '_offsets' else self.columns[field]
+			with open(self.col_path(field), 'rb') as f:
+				if os.fstat(f.fileno()).st_size == 0:  # empty files cannot be mapped
+					self.views[field] = memoryview(array(typecode))
+				else:
+					self.views[field] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+		return self.views[field]
+
+
+	def side_data(self):
+		if self.side_map is None:
+			with open(os.path.join(self.dirname, 'side.json'), 'rb') as f:
+				if os.fstat(f.fileno()).st_size == 0:
+					return b''
+				self.side_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return self.side_map
+
+
+	def remap(self):
+		""" drop the mappings after an append, views handed out stay valid """
+		self.views = {}
+		self.side_map = None
+
+
+	@property
+	def ts(self):
+		return self.view(self.ts_field)
+
+
+	@property
+	def offsets(self):
+		""" start of each record in the side file """
+		return self.view('_offsets')
+
+
+	def open(self):
+		os.makedirs(self.dirname, exist_ok=True)
+		paths = [(self.col_path(f), self.columns[f]) for f in self.columns]
+		if len(self.side) > 0:
+			paths.append((self.col_path('_offsets'), 'q'))
+		count = None
+		for path, typecode in paths:
+			size = os.path.getsize(path) if os.path.exists(path) else 0
+			n = size // array(typecode).itemsize
+			count = n if count is None else min(count, n)
+		for path, typecode in paths:
+			self.truncate(path, count * array(typecode).itemsize)
+		if len(self.side) > 0:
+			side_path = os.path.join(self.dirname, 'side.json')
+			self.truncate(side_path, self.offsets[-1] + self.side_len(count - 1) if count > 0 else 0)
+		self.remap()
+		logger.info("ColumnArchive %s: %s records", self.dirname, count)
+
+
+	def truncate(self, path, size):
+		with open(path, 'ab') as f:
+			if f.tell() != size:
+				logger.warning("ColumnArchive %s: truncating %s to %s bytes", self.dirname, path, size)
+				f.truncate(size)
+
+
+	def side_len(self, i):
+		""" length of side record i, the last one is read from the file """
+		if i + 1 < len(self.offsets):
+			return self.offsets[i + 1] - self.offsets[i]
+		data = self.side_data()
+		end = data.find(b'\n', self.offsets[i])
+		return (len(data) if end < 0 else end + 1) - self.offsets[i]
+
+
+	def append_many(self, recs):
+		""" append records newer than the last archived one, in time stamp order
+			return the number appended
+		"""
+		last = self.ts[-1] if len(self.ts) > 0 else None
+		recs = sorted([r for r in recs if last is None or r[self.ts_field] > last], key=lambda r: r[self.ts_field])
+		if len(recs) == 0:
+			return 0
+
+		if len(self.side) > 0:
+			side_path = os.path.join(self.dirname, 'side.json')
+			offsets = array('q')
+			with open(side_path, 'ab') as f:
+				for rec in recs:
+					offsets.append(f.tell())
+					line = json.dumps([rec.get(field) for field in self.side], separators=(',', ':'))
+					f.write(line.encode('utf-8') + b'\n')
+			with open(self.col_path('_offsets'), 'ab') as f:
+				offsets.tofile(f)
+
+		for field in reversed(self.columns):  # time stamp last
+			encode = self.encode.get(field)
+			values = [rec.get(field) for rec in recs]
+			if encode is not None:
+				values = [encode(v) for v in values]
+			col = array(self.columns[field], [0 if v is None else v for v in values])
+			with open(self.col_path(field), 'ab') as f:
+				col.tofile(f)
+		self.remap()
+		if 'dbops' in DBGK: logger.debug("ColumnArchive %s: appended %s records", self.dirname, len(recs))
+		return len(recs)
+
+
+	def read_column(self, field, lo, hi):
+		return self.view(field)[lo:hi]
+
+
+	def read_side(self, lo, hi):
+		""" side field values of records lo..hi-1, as a list per side field """
+		res = [[] for field in self.side]
+		if hi <= lo:
+			return res
+		offsets = self.offsets
+		data = self.side_data()
+		end = offsets[hi] if hi < len(offsets) else len(data)
+		for line in data[offsets[lo]:end].splitlines():
+			for vals, val in zip(res, json.loads(line.decode('utf-8'))):
+				vals.append(val)
+		return res
+
+
+	def select(self, start=None, end=None, fields=None, eq=None):
+		""" columns of the records with start <= time stamp <= end
+			fields selects the columns, default all, eq is a dict of
+			column: value that records must match, e.g. {'slid': 3}
+			returns a dict of field: memoryview, arrays if eq is given,
+			lists for side fields
+		"""
+		if fields is None:
+			fields = list(self.columns) + self.side
+		lo = 0 if start is None else bisect.bisect_left(self.ts, start)
+		hi = len(self.ts) if end is None else bisect.bisect_right(self.ts, end)
+		hi = max(lo, hi)
+
+		res = {}
+		for field in fields:
+			if field in self.columns:
+				res[field] = self.read_column(field, lo, hi)
+		if any(field in self.side for field in fields):
+			side = self.read_side(lo, hi)
+			for field, vals in zip(self.side, side):
+				if field in fields:
+					res[field] = vals
+
+		if eq is not None and hi > lo:
+			keep = None
+			for field in eq:
+				col = res[field] if field in res else self.read_column(field, lo, hi)
+				value = self.encode[field](eq[field]) if field in self.encode else eq[field]
+				match = [v == value for v in col]
+				keep = match if keep is None else [a and b for a, b in zip(keep, match)]
+			for field in res:
+				vals = [v for v, k in zip(res[field], keep) if k]
+				res[field] = array(self.columns[field], vals) if field in self.columns else vals
+		if 'dbops' in DBGK: logger.debug("ColumnArchive %s select %s..%s: %s records", self.dirname, start, end, hi - lo)
+		return res
+
+
+	def rank(self, ts, right=False):
+		""" number of records with time stamps < ts (<= ts if right) """
+		if right:
+			return bisect.bisect_right(self.ts, ts)
+		return bisect.bisect_left(self.ts, ts)
+
+
+	def records(self, lo, hi):
+		""" records lo..hi-1 as dicts """
+		cols = [(field, self.read_column(field, lo, hi)) for field in self.columns]
+		side = self.read_side(lo, hi) if len(self.side) > 0 else []
+		recs = []
+		for i in range(hi - lo):
+			rec = {field: col[i] for field, col in cols}
+			for field, vals in zip(self.side, side):
+				rec[field] = vals[i]
+			for field in self.decode:
+				rec[field] = self.decode[field](rec[field])
+			recs.append(rec)
+		return recs
+
+
+	def before(self, ts, count, match=None):
+		""" the last count records with time stamps < ts for which match(rec) is true,
+			in time stamp order, reading back PAGE_RECORDS records at a time
+		"""
+		res = []
+		hi = self.rank(ts)
+		while hi > 0 and len(res) < count:
+			lo = max(0, hi - max(count, self.PAGE_RECORDS))
+			res[:0] = [rec for rec in self.records(lo, hi) if match is None or match(rec)]
+			hi = lo
+		return res[-count:] if count > 0 else []
+
+
+	def after(self, ts, count, match=None):
+		""" the first count records with time stamps > ts for which match(rec) is true """
+		res = []
+		lo = self.rank(ts, right=True)
+		while lo < len(self) and len(res) < count:
+			hi = min(len(self), lo + max(count, self.PAGE_RECORDS))
+			res.extend(rec for rec in self.records(lo, hi) if match is None or match(rec))
+			lo = hi
+		return res[:count]
+
+
+	def __len__(self):
+		return len(self.ts)
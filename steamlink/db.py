@@ -1,131 +1,143 @@
 # python library Steamlink
 
-import bisect
+import asyncio
+import itertools
+import json
 import logging
-from collections import OrderedDict
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from tinydb import TinyDB, Query, where
-from tinydb.middlewares import CachingMiddleware
-from tinydb.storages import JSONStorage
+from tinydb import TinyDB
+from tinydb.storages import Storage
 
 from . import (DBG, DBGK)
+from .dbindex import DBIndexFarm, DBFieldIndex, INDEX_MAX, INDEX_MAX_KEYS
+from .lazytable import LazyTable
+from .query import Query, QueryPlanner, Aggregation, RANGE_OPS
+from .seglog import SegLogTable
+from .sqlitedb import SQLiteDB, SQLiteTable
+from .writebehind import DBWriter, WriteBehindTable
 
 logger = logging.getLogger()
 
 
-#
-# DBIndex
-#
-class DBIndex(OrderedDict):
-	def __init__(self, table, csk):
-		self.table = table
-		self.csk = csk
-		self.key_field = csk.key_field
-		super().__init__()
-
-		if 'dbops' in DBGK: logger.debug("DBIndex __init__ %s", csk)
-		for item in self.table:
-			if self.csk.check_restrictions(item):
-				self[item[self.key_field]] = item
-		if 'dbops' in DBGK: logger.debug("DBIndex __init__ count %s", len(self))
-
-
-	def has(self, key):
-		return key in self
-
-
-	def db_update(self, item):  # N.B. handle change of key value
-		key = item[self.key_field]
-		if self.csk.check_restrictions(item):
-			super().__setitem__(key, item)
-
-
-	def db_insert(self, item):
-		key = item[self.key_field]
-		if self.csk.check_restrictions(item):
-			super().__setitem__(key, item)
-
-
-	def db_delete(self, item):
-		if 'dbops' in DBGK: logger.debug("DBIndex  deleting item %s", item)
-		key = item[self.key_field]
-		if key in self:
-			del self[key]
-
-
-#
-# DBIndexFarm
-#
-class DBIndexFarm(dict):
-	def __init__(self, table):
-		self.table = table
-		super().__init__()
-
-
-	@staticmethod
-	def mk_restrict_idx_name(csk):
-		name = ""
-		for restrict in csk.restrict_by:
-			name += "%s%s%s" % (restrict['field_name'], restrict['op'], restrict['value'])
-		return name
-
-
-	def get_idx(self, csk):
-		key_field = csk.key_field
-		restrict_name = key_field + self.mk_restrict_idx_name(csk)
-		if 'dbops' in DBGK: logger.debug("DBIndexFarm get name '%s'", restrict_name)
-		if restrict_name not in self:
-			self[restrict_name] = DBIndex(self.table, csk)
-		return self[restrict_name]
-
-
-	def db_update(self, item):
-		for idx in self:
-			self[idx].db_update(item)
-
-
-	def db_insert(self, item):
-		for idx in self:
-			self[idx].db_insert(item)
-
-
-	def db_delete(self, item):
-		if 'dbops' in DBGK: logger.debug("DBIndexFarm  deleting item %s", item)
-		for idx in self:
-			self[idx].db_delete(item)
-
-
 #
 # DBTable
 #
 class DBTable:
-	def __init__(self, table, name, key_field):
+	""" a TinyDB table
+		writes go directly to the table's documents in DBFileStorage, using
+		a key to doc_id map, so insert, update and delete are O(1)
+		fields listed in indexes get a DBFieldIndex for '==' get and search,
+		(field, key_field) tuples get a DBCompositeIndex for get_range
+		queries are planned by a QueryPlanner over the key map, the field
+		indexes and the unrestricted DBIndex on the key
+	"""
+
+
+	def __init__(self, table, name, key_field, docs, indexes=()):
 		if DBG > 2: logger.debug("DBTable %s", name)
 		self.table = table
+		self.docs = docs  # doc_id -> document, the table data in DBFileStorage
 		self.name = name
 		self.key_field = key_field  # field that is unique for this table
-		self.restrict_idxs = DBIndexFarm(self.table)
-		self.query = Query()
+		self.doc_ids = {}  # key -> doc_id
+		for doc_id in self.docs:
+			self.doc_ids[self.docs[doc_id][key_field]] = doc_id
+		self.next_id = max([int(doc_id) for doc_id in self.docs], default=0) + 1
+		self.field_idxs = {}
+		for field in [f for f in indexes if isinstance(f, str)]:
+			self.field_idxs[field] = DBFieldIndex(field, key_field, self.docs.values())
+		self.restrict_idxs = DBIndexFarm(self.table, key_field, self.record,
+										 [f for f in indexes if not isinstance(f, str)])
+		self.planner = QueryPlanner(key_field, self.field_idxs, self.restrict_idxs.sorted_fields)
+		self.store = None  # DBStore that journals the changes
+
+
+	def log(self, op, key, rec):
+		""" write a change to the journal of the store, op is 'put', 'upd' or 'del' """
+		if self.store is not None:
+			self.store.log(self, op, key, rec)
 
 
 	def db_insert(self, rec):
 		assert self.key_field in rec, "record has not key_field"
 		r = rec[self.key_field]
-		el = self.table.search(where(self.key_field) == r)
-		if 'dbops' in DBGK: logger.debug("upsert search %s return %s", (where(self.key_field) == r), el)
-		if el is not None and len(el) > 0:
-			logger.error("duplicate record %s, %s rec %s, %s", self.name, el, r, rec)
+		if r in self.doc_ids:
+			logger.error("duplicate record %s, %s rec %s, %s", self.name, self.doc_ids[r], r, rec)
 			return
-		did = self.table.insert(rec)
-		if 'dbops' in DBGK: logger.debug("upsert insert %s rec %s, %s: %s", self.name, did, type(rec), rec)
-		self.restrict_idxs.db_insert(rec)
+		did = str(self.next_id)
+		self.next_id += 1
+		doc = dict(rec)
+		self.docs[did] = doc
+		self.doc_ids[r] = did
+		for field in self.field_idxs:
+			self.field_idxs[field].db_insert(doc)
+		if 'dbops' in DBGK: logger.debug("insert %s rec %s, %s: %s", self.name, did, type(rec), rec)
+		self.log('put', r, doc)
+		self.restrict_idxs.db_insert(doc)
+
+
+	def insert_many(self, recs):
+		""" insert a batch of records, the indexes are updated once per batch """
+		new = []
+		for rec in recs:
+			assert self.key_field in rec, "record has not key_field"
+			r = rec[self.key_field]
+			if r in self.doc_ids:
+				logger.error("duplicate record %s, %s rec %s, %s", self.name, self.doc_ids[r], r, rec)
+				continue
+			did = str(self.next_id)
+			self.next_id += 1
+			doc = dict(rec)
+			self.docs[did] = doc
+			self.doc_ids[r] = did
+			self.log('put', r, doc)
+			new.append(doc)
+		for field in self.field_idxs:
+			for doc in new:
+				self.field_idxs[field].db_insert(doc)
+		if 'dbops' in DBGK: logger.debug("insert_many %s %s recs", self.name, len(new))
+		self.restrict_idxs.insert_many(new)
 
 
 	def db_update(self, rec):
 		if 'dbops' in DBGK: logger.debug("REC update %s rec %s", self.name, rec)
-		self.restrict_idxs.db_update(rec)
 		key = rec[self.key_field]
-		self.table.update(rec, where(self.key_field) == key)
+		did = self.doc_ids.get(key)
+		if did is None:  # N.B. not in the DBIndexes either, they can only hold keys of documents
+			if 'dbops' in DBGK: logger.debug("update in %s, no document with %s=%s", self.name, self.key_field, key)
+			return
+		old = self.docs[did]
+		doc = dict(old)  # N.B. replace, don't modify, a compaction may be writing it
+		doc.update(rec)
+		self.docs[did] = doc
+		for field in self.field_idxs:
+			self.field_idxs[field].db_update(old, doc)
+		self.log('upd', key, rec)
+		self.restrict_idxs.db_update(doc)
+
+
+	def update_many(self, recs):
+		""" update a batch of records, the DBIndexes are updated once per batch """
+		if 'dbops' in DBGK: logger.debug("update_many %s %s recs", self.name, len(recs))
+		updated = []
+		for rec in recs:
+			key = rec[self.key_field]
+			did = self.doc_ids.get(key)
+			if did is None:  # e.g. deleted by retention, see db_update
+				continue
+			old = self.docs[did]
+			doc = dict(old)
+			doc.update(rec)
+			self.docs[did] = doc
+			for field in self.field_idxs:
+				self.field_idxs[field].db_update(old, doc)
+			self.log('upd', key, rec)
+			updated.append(doc)
+		self.restrict_idxs.update_many(updated)
 
 
 	def db_delete(self, rec):
@@ -133,28 +145,101 @@ class DBTable:
 		val = rec[field]
 		if 'dbops' in DBGK: logger.debug("DBtable  deleting field=%s val=%s", field, val)
 		self.restrict_idxs.db_delete(rec)
-		el = self.table.get(where(field) == val)
-		if el is None:
+		did = self.doc_ids.pop(val, None)
+		if did is None:
 			logger.error("delete in %s, no document with %s=%s", self.name, field, val)
 			raise ValueError
+		for field in self.field_idxs:
+			self.field_idxs[field].db_delete(self.docs[did])
+		del self.docs[did]
+		self.log('del', val, None)
+
+
+	def record(self, key):
+		return self.docs[self.doc_ids[key]]
 
-		try:
-			self.table.remove(eids=[el.eid])
-		except KeyError as e:
-			logger.error("delete in %s, no docid %s", self.name, el.eid)
+
+	def key_at(self, pos):
+		""" the key at position pos in key order, None if pos is past the end """
+		if pos >= len(self.doc_ids):
+			return None
+		return self.restrict_idxs.sorted_idx(self.key_field, build=True, hold=True).keys()[pos]
+
+
+	def delete_before(self, key, inclusive=False):
+		""" delete the records with keys < key (<= key if inclusive), return their number
+			the keys are found through the unrestricted DBIndex on the table key,
+			which is built and held for good, as retention calls this every run
+		"""
+		idx = self.restrict_idxs.sorted_idx(self.key_field, build=True, hold=True)
+		doomed = list(idx.irange_op('<=' if inclusive else '<', key))
+		recs = []
+		for k in doomed:
+			did = self.doc_ids.pop(k)
+			rec = self.docs.pop(did)
+			for field in self.field_idxs:
+				self.field_idxs[field].db_delete(rec)
+			self.log('del', k, None)
+			recs.append(rec)
+		self.restrict_idxs.delete_many(recs)
+		if 'dbops' in DBGK: logger.debug("delete_before %s %s: %s recs", self.name, key, len(recs))
+		return len(recs)
+
+
+	def size_bytes(self):
+		""" estimated size of the records as json """
+		sample = [self.docs[did] for did in itertools.islice(self.docs, 100)]
+		if len(sample) == 0:
+			return 0
+		return len(self.docs) * len(json.dumps(sample)) // len(sample)
+
+
+	def matches(self, query):
+		""" generate the documents matching a Query, not copies """
+		plan = self.planner.plan(query)
+		if plan.method == 'scan':
+			docs = list(self.docs.values())
+		else:
+			pred = query.preds[plan.pos]
+			if plan.method == 'primary':
+				keys = pred.values()
+			elif plan.method == 'secondary':
+				keys = [key for val in pred.values() for key in self.field_idxs[pred.field].lookup(val)]
+			else:  # sorted
+				idx = self.restrict_idxs.sorted_idx(pred.field)
+				keys = [idx.table_key_of(k) for k in idx.irange_op(pred.op, pred.value)]
+			docs = [self.docs[self.doc_ids[key]] for key in keys if key in self.doc_ids]
+		if 'dbops' in DBGK: logger.debug("select %s %s: %s, %s candidates", self.name, query, plan, len(docs))
+		for doc in docs:
+			if query.match(doc):
+				yield doc
+
+
+	def select(self, query):
+		""" generate copies of the documents matching a Query """
+		for doc in self.matches(query):
+			yield dict(doc)
+
+
+	def aggregate(self, query, aggs, group_by=None):
+		""" the rows of an Aggregation over the documents matching a Query
+			a range on the table key is read through the unrestricted DBIndex
+			on it, which is built if needed
+		"""
+		if any(p.field == self.key_field and p.op in RANGE_OPS for p in query.preds):
+			self.restrict_idxs.sorted_idx(self.key_field, build=True)
+		return Aggregation(aggs, group_by).add_many(self.matches(query)).rows()
 
 
 	def get(self, field, op, val):
-		q = "self.table.get(where('%s') %s %s)" % (field, op, repr(val))
-		res = eval(q)
-		if 'dbops' in DBGK: logger.debug("get %s rec %s: %s", self.name, q, res)
+		res = next(self.select(Query.where(field, op, val)), None)
+		if 'dbops' in DBGK: logger.debug("get %s rec %s %s %s: %s", self.name, field, op, val, res)
 		return res
 
 
 	def search(self, field, op, val):
-		q = "self.table.search(where('%s') %s %s)" % (field, op, repr(val))
-		res = eval(q)
-		if 'dbops' in DBGK: logger.debug("search %s rec %s: %s", self.name, q, res)
+		res = list(self.select(Query.where(field, op, val)))
+		if 'dbops' in DBGK: logger.debug("search %s rec %s %s %s: %s", self.name, field, op, val, res)
 		return res
 
 
@@ -162,75 +247,324 @@ class DBTable:
 		""" get a range of records, obeying restrictions
 		- if start_key is null, use start_item_number.
 		- if start_item_number is negative start from the end
-		if 'get_range' in DBGK: logger.debug("get_range: %s", str(csk))
+		records are copies, as for select(), loading an item may modify them
 		"""
-		if 'get_range' in DBGK: logger.debug("get_range csk %s", str(csk))
-		key_field = csk.key_field
-		startv = csk.start_key
-		endv = csk.end_key
-		count = csk.count
-
-		csk.total_item_count = 0
-
-		if 'get_range' in DBGK: logger.debug("get_range csk2 %s", str(csk))
-		if False:
-			#		if len(self.table) == 0:
-			if 'get_range' in DBGK: logger.debug("get_range table empty")
-			csk.count = 0
-			return {}
-
 		if 'get_range' in DBGK: logger.debug("get_range num idexes %s", len(self.restrict_idxs))
-
 		idx = self.restrict_idxs.get_idx(csk)
+		for doc in idx.get_range(csk):
+			yield dict(doc)
 
-		if len(idx) == 0:
-			if 'get_range' in DBGK: logger.debug("get_range table empty after destrict")
-			return {}
 
-		if startv in [None]:
-			if csk.start_item_number < 0:
-				sidx = max(0, len(idx) + csk.start_item_number)
-			else:
-				sidx = min(csk.start_item_number, len(idx) - 1)
-			startv = list(idx)[sidx]
-		else:
-			sidx = bisect.bisect_left(list(idx), startv)
-			if sidx == len(idx):
-				if 'get_range' in DBGK: logger.debug("get_range no start key found")
-				return {}
-
-		if endv in [None]:
-			eidx = min(sidx + count - 1, len(idx) - 1)
-			endv = list(idx)[eidx]
-		else:
-			eidx = bisect.bisect_right(list(idx), endv, sidx, len(idx)) - 1
-			if eidx < 0:
-				if 'get_range' in DBGK: logger.debug("get_range no end key found")
-				return {}
-			count = eidx - sidx + 1
+	def flush(self):
+		pass
 
-		csk.start_key = list(idx)[sidx]
-		csk.end_key = list(idx)[eidx]
-		csk.start_item_number = sidx
-		csk.count = count
-		csk.total_item_count = len(idx)
-		csk.at_start = csk.start_key == list(idx)[0]
-		csk.at_end = csk.end_key == list(idx)[-1]
 
-		if 'get_range' in DBGK: logger.debug("get_range size %s", (eidx - sidx + 1))
-		for i in range(sidx, eidx + 1):
-			yield idx[list(idx)[i]]
+	def __len__(self):
+		return len(self.docs)
 
 
-	def __len__(self):
-		return len(self.table)
+#
+# DBFileStorage
+#
+class DBFileStorage(Storage):
+	""" tinydb storage that reads the json file once and keeps all data in
+		memory, writing the file is left to DBStore
+	"""
+
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.data = None
+		self.generation = 0  # of the data in the file, see DBStore
+
+
+	def read(self):
+		if self.data is None:
+			try:
+				with open(self.filename) as f:
+					self.data = json.load(f)
+			except FileNotFoundError:
+				self.data = {}
+			except ValueError as e:  # written in place by an old version and torn
+				logger.error("DBFileStorage %s: unreadable, moved to .bad, starting from the journal: %s",
+							 self.filename, e)
+				os.replace(self.filename, self.filename + '.bad')
+				self.data = {}
+			self.generation = self.data.pop('_generation', 0)
+		return self.data
+
+
+	def write(self, data):
+		self.data = data
+
+
+	def close(self):
+		pass
+
+
+#
+# DBStore
+#
+class DBStore:
+	""" a TinyDB file with a write-ahead journal
+		- every change is appended to the journal as it is made, so its cost
+		  depends on the write rate, not the db size
+		- the journal is fsynced at most every fsync_interval seconds, 0 syncs
+		  every change, a negative interval leaves it to the OS
+		- with a lock, the DBWriter's, changes are logged to a buffer, and
+		  written to the journal by write_out(), which the writer calls
+		  without the lock, so readers do not wait for the disk
+		- when the journal exceeds journal_max_bytes it is compacted: the db
+		  is written to a new file in the executor and the journal dropped,
+		  the db file is the checkpoint
+		- open() replays the journals written since the last checkpoint and
+		  compacts them in the background
+		- the generation counts the changes, it is kept in the db file;
+		  close() saves the keys of the DBIndexes with it, they are restored
+		  when a table is opened at the same generation
+	"""
+
+
+	def __init__(self, filename, executor, journal_max_bytes, flush_interval=0, fsync_interval=1.0, lock=None):
+		self.filename = filename
+		self.journal_name = filename + '.journal'
+		self.executor = executor
+		self.journal_max_bytes = journal_max_bytes
+		self.flush_interval = flush_interval  # seconds between flushes, see DB.flush
+		self.fsync_interval = fsync_interval
+		self.last_flush = 0
+		self.last_sync = 0
+		self.unsynced = 0  # changes written since the last sync
+		self.buffered = lock is not None
+		self.lock = lock if lock is not None else threading.RLock()  # held to change or copy the tables
+		self.buffer = []  # journal lines not written yet, when buffered
+		self.generation = 0
+		self.saved_idxs = {}  # table name -> DBIndexFarm.save() of the last close
+		self.db = None
+		self.tables = {}
+		self.journal = None
+		self.compaction = None  # future of a running compaction
+
+
+	def open(self):
+		self.db = TinyDB(self.filename, storage=DBFileStorage)
+		self.db._storage.read()
+		self.generation = self.db._storage.generation
+		old_journal = self.journal_name + '.old'
+		journals = [j for j in [old_journal, self.journal_name] if os.path.exists(j)]
+		if len(journals) > 0:
+			self.replay(journals)
+			if os.path.exists(self.journal_name):
+				self.append_journal(self.journal_name, old_journal)
+		self.journal = open(self.journal_name, 'a')
+		if len(journals) > 0:
+			self.compaction = self.executor.submit(self.compact, self.snapshot(), old_journal)
+		self.load_indexes()
+
+
+	def load_indexes(self):
+		try:
+			with open(self.filename + '.indexes') as f:
+				saved = json.load(f)
+		except (OSError, ValueError):
+			return
+		if saved['generation'] != self.generation:
+			logger.info("DBStore %s: saved indexes are stale", self.filename)
+			return
+		self.saved_idxs = saved['tables']
+
+
+	def save_indexes(self):
+		saved = {'generation': self.generation, 'tables': {}}
+		for name in self.tables:
+			table = self.tables[name]
+			saved['tables'][name] = table.restrict_idxs.save()
+		with open(self.filename + '.indexes.tmp', 'w') as f:
+			json.dump(saved, f)
+		os.replace(self.filename + '.indexes.tmp', self.filename + '.indexes')
+
+
+	def append_journal(self, src, dst):
+		""" move the complete entries of journal src to the end of journal dst """
+		with open(src, 'rb') as f:
+			data = f.read()
+		with open(dst, 'ab') as f:
+			f.write(data[:data.rfind(b'\n') + 1])
+			f.flush()
+			os.fsync(f.fileno())
+		os.unlink(src)
+
+
+	def table(self, name, key_field, indexes=()):
+		db_table = self.db.table(name)
+		table = DBTable(db_table, name, key_field, self.db._storage.read()[name], indexes)
+		table.store = self
+		if name in self.saved_idxs:
+			table.restrict_idxs.restore(self.saved_idxs.pop(name))
+			logger.info("DBStore %s: restored indexes of %s", self.filename, name)
+		self.tables[name] = table
+		return table
+
+
+	def log(self, table, op, key, rec):
+		e = {'t': table.name, 'f': table.key_field, 'k': key, 'op': op, 'r': rec}
+		line = json.dumps(e, separators=(',', ':')) + '\n'
+		self.unsynced += 1
+		self.generation += 1
+		if self.buffered:
+			self.buffer.append(line)
+			return
+		self.journal.write(line)
+		if self.fsync_interval >= 0 and time.time() - self.last_sync >= self.fsync_interval:
+			self.sync()
+
+
+	def write_out(self):
+		""" sync the buffered changes if the fsync interval passed, not holding the lock """
+		if self.unsynced > 0 and 0 <= self.fsync_interval <= time.time() - self.last_sync:
+			self.sync()
+
+
+	def sync(self):
+		""" write the journal through to disk """
+		with self.lock:
+			lines, self.buffer = self.buffer, []
+			synced, self.unsynced = self.unsynced, 0
+		if len(lines) > 0:
+			self.journal.write(''.join(lines))
+		self.journal.flush()
+		if self.fsync_interval >= 0:
+			os.fsync(self.journal.fileno())
+		if 'dbops' in DBGK: logger.debug("DBStore %s: synced %s changes", self.filename, synced)
+		self.last_sync = time.time()
+
+
+	def replay(self, journals):
+		""" apply journal entries to the tables """
+		changes = {}  # table name -> (key_field, {key: (op, rec)})
+		for j in journals:
+			logger.info("DBStore %s: replaying %s", self.filename, j)
+			with open(j) as f:
+				for line in f:
+					try:
+						e = json.loads(line)
+					except ValueError:
+						logger.warning("DBStore %s: bad journal entry '%s'", j, line)
+						continue
+					self.generation += 1
+					key_field, recs = changes.setdefault(e['t'], (e['f'], {}))
+					prev = recs.get(e['k'])
+					if e['op'] == 'upd' and prev is not None and prev[0] != 'del':
+						merged = dict(prev[1])
+						merged.update(e['r'])
+						recs[e['k']] = (prev[0], merged)
+					else:
+						recs[e['k']] = (e['op'], e['r'])
+
+		for name in changes:
+			key_field, recs = changes[name]
+			table = self.db.table(name)
+			doc_ids = {}
+			docs = {}
+			for doc in table:
+				if doc.get(key_field) in recs:
+					doc_ids[doc[key_field]] = doc.doc_id
+					docs[doc[key_field]] = doc
+			new_docs = []
+			for key in recs:
+				op, rec = recs[key]
+				if op == 'upd' and key in docs:
+					rec = dict(docs[key], **rec)
+				if op != 'del':
+					new_docs.append(rec)
+			table.remove(doc_ids=list(doc_ids.values()))
+			table.insert_multiple(new_docs)
+			logger.info("DBStore %s: replayed %s changes to %s", self.filename, len(recs), name)
+
+
+	def snapshot(self):
+		""" copy of the table dicts, documents are replaced, not modified, on update """
+		with self.lock:
+			data = self.db._storage.read()
+			snapshot = {name: dict(data[name]) for name in data}
+			snapshot['_generation'] = self.generation
+		return snapshot
+
+
+	def write_db(self, data):
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(data, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.filename)
+
+
+	def compact(self, data, old_journal):
+		try:
+			self.write_db(data)
+		except Exception as e:
+			logger.error("DBStore %s: compaction failed: %s", self.filename, e)
+			return False
+		os.unlink(old_journal)
+		if 'dbops' in DBGK: logger.debug("DBStore %s: compacted", self.filename)
+		return True
+
+
+	def flush(self):
+		self.last_flush = time.time()
+		if self.unsynced > 0:
+			self.sync()
+
+		if self.compaction is not None:
+			if not self.compaction.done():
+				return
+			if not self.compaction.result():  # failed, old journal still needed
+				self.compaction = None
+				return
+			self.compaction = None
+		if self.journal.tell() > self.journal_max_bytes:
+			old_journal = self.journal_name + '.old'
+			self.journal.close()
+			os.replace(self.journal_name, old_journal)
+			self.journal = open(self.journal_name, 'a')
+			self.compaction = self.executor.submit(self.compact, self.snapshot(), old_journal)
+
+
+	def close(self):
+		self.flush()
+		if self.compaction is not None:
+			self.compaction.result()
+		self.journal.close()
+		self.write_db(self.snapshot())
+		self.save_indexes()
+		os.unlink(self.journal_name)
+		if os.path.exists(self.journal_name + '.old'):
+			os.unlink(self.journal_name + '.old')
+		self.db.close()
+		self.db = None
 
 
 class DB:
 	""" Notes:
-			- inserts get slow with the standard Json modules, check out ujson
-			    ( at 3000 items, the per item insert time is 12ms!! )
-			- consider creating a new table/db/fle very day or every x records
+			- seglog tables start a new segment file every day or every x records,
+			  see conf 'partition_seconds' and 'segment_records'
+			- the tinydb backend writes changes ahead to a journal, see DBStore
+			- conf 'backend' selects the storage: 'tinydb' (default) keeps the whole
+			  db in memory as one json document, 'sqlite' keeps it in a sqlite
+			  file (conf 'sqlite_filename') with O(log n) inserts
+			- tables listed in conf 'seglog_tables' are append-only segment logs
+			  in conf 'seglog_dir', independent of the backend
+			- tinydb tables are in conf 'db_filename', or in a file of their own
+			  if conf 'table_dir' is set, or conf 'tables' gives a 'filename' for
+			  them; each file is a DBStore that is flushed at most every
+			  'flush_interval' seconds, and fsyncs its journal at most every
+			  'journal_fsync' seconds, so hot and cold tables can differ
+			- tables in conf 'lazy_tables' get a file of their own that is loaded
+			  in the background, so startup does not wait for them, see LazyTable
+			- with conf 'write_behind' the tables are written by a DBWriter thread,
+			  so disk stalls do not block the event loop, see WriteBehindTable;
+			  the journals are written and synced by it too, without its lock
 
 	"""
 
@@ -240,24 +574,152 @@ class DB:
 		self.name = "DB"
 		self.conf = conf
 		self.loop = loop
+		self.backend = conf.get('backend', 'tinydb')
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.writer = None
 		self.db = None
+		self.stores = {}  # filename -> DBStore, for the tinydb backend
+		self.loading = {}  # filename -> LazyTable being loaded
+		self.farms = {}  # table name -> DBIndexFarm of the table
 		self.db_tables = {}
 
 
 	async def start(self):
 
+		if self.conf.get('write_behind', False):
+			self.writer = DBWriter(self.conf.get('write_queue_max', 10000))
+			self.writer.after(self.write_journals)
+			self.writer.start()
+		if self.backend == 'sqlite':
+			logger.info("%s opening sqlite DB %s", self.name, self.conf['sqlite_filename'])
+			self.db = SQLiteDB(self.conf['sqlite_filename'])
+			return
+		if self.backend != 'tinydb':
+			logger.error("%s unknown backend '%s', using tinydb", self.name, self.backend)
+			self.backend = 'tinydb'
+
 		logger.info("%s opening DB %s", self.name, self.conf['db_filename'])
-		self.db = TinyDB(self.conf['db_filename'],
-						 sort_keys=True, indent=4, separators=(',', ': '),
-						 storage=CachingMiddleware(JSONStorage))
+		self.db = DBStore(self.conf['db_filename'], self.executor,
+						  self.conf.get('journal_max_bytes', 4 * 1024 * 1024),
+						  self.conf.get('flush_interval', 0), self.conf.get('journal_fsync', 1.0), self.writer_lock())
+		self.db.open()
+		self.stores[self.conf['db_filename']] = self.db
+
+
+	def store_filename(self, name):
+		""" file of the DBStore for table name, lazy tables get a file of their own """
+		filename = self.conf.get('tables', {}).get(name, {}).get('filename')
+		if filename is None and self.conf.get('table_dir') is not None:
+			filename = os.path.join(self.conf['table_dir'], name + '.db')
+		if filename is None and name in self.conf.get('lazy_tables', []):
+			filename = os.path.join(os.path.dirname(self.conf['db_filename']), name + '.db')
+		if filename is None:
+			filename = self.conf['db_filename']
+		return filename
+
+
+	def new_store(self, name, filename):
+		logger.info("%s opening DB %s for table %s", self.name, filename, name)
+		if os.path.dirname(filename) != '':
+			os.makedirs(os.path.dirname(filename), exist_ok=True)
+		store = DBStore(filename, self.executor, self.conf.get('journal_max_bytes', 4 * 1024 * 1024),
+						self.flush_interval(name), self.journal_fsync(name), self.writer_lock())
+		store.open()
+		return store
+
+
+	def writer_lock(self):
+		return self.writer.lock if self.writer is not None else None
+
+
+	def flush_interval(self, name):
+		return self.conf.get('tables', {}).get(name, {}).get('flush_interval', self.conf.get('flush_interval', 0))
+
+
+	def journal_fsync(self, name):
+		return self.conf.get('tables', {}).get(name, {}).get('journal_fsync', self.conf.get('journal_fsync', 1.0))
+
+
+	def store(self, name):
+		""" return the DBStore for table name, opening it if needed """
+		filename = self.store_filename(name)
+		if filename in self.loading:  # shared with a table being loaded
+			self.loading[filename].loaded()
+		store = self.stores.get(filename)
+		if store is None:
+			store = self.new_store(name, filename)
+			self.stores[filename] = store
+		store.flush_interval = min(store.flush_interval, self.flush_interval(name))
+		fsync = self.journal_fsync(name)  # a shared store syncs for the most demanding table
+		if store.fsync_interval < 0 or 0 <= fsync < store.fsync_interval:
+			store.fsync_interval = fsync
+		return store
+
+
+	def lazy(self, name):
+		""" true if table name is in conf 'lazy_tables' and its file is not in use,
+			tables still in db_filename are loaded, and moved out, first
+		"""
+		filename = self.store_filename(name)
+		return name in self.conf.get('lazy_tables', []) and filename not in self.stores \
+			and filename not in self.loading and name not in self.db.db.tables()
+
+
+	def load_table(self, name, filename, key_field, indexes):
+		""" open the store of a lazy table and build the table, in the executor """
+		t = time.time()
+		table = self.new_store(name, filename).table(name, key_field, indexes)
+		self.add_farm(name, table)
+		logger.info("%s loaded %s, %s records in %.1fs", self.name, name, len(table), time.time() - t)
+		return table
 
 
-	def table(self, name, key_field):
+	def loaded(self, table):
+		""" a lazy table is in use, its store is flushed and closed with the others """
+		self.stores[table.store.filename] = table.store
+		self.loading.pop(table.store.filename, None)
+
+
+	def migrate(self, name, table):
+		""" move table name out of the db_filename store, into table of its own store """
+		if name not in self.db.db.tables():
+			return
+		if len(table) == 0:
+			docs = [dict(doc) for doc in self.db.db.table(name)]
+			logger.info("%s moving %s records of %s from %s", self.name, len(docs), name, self.db.filename)
+			table.insert_many(docs)
+		self.db.db.purge_table(name)
+
+
+	def table(self, name, key_field, indexes=()):
+		""" return the DBTable for name, indexes lists fields to keep a secondary index for,
+			and (field, key_field) tuples for composite indexes
+		"""
 		if name in self.db_tables:
 			return self.db_tables[name]
 
-		db_table = self.db.table(name)
-		table = DBTable(db_table, name, key_field)
+		if name in self.conf.get('seglog_tables', []):
+			table = SegLogTable(os.path.join(self.conf['seglog_dir'], name), name, key_field,
+								self.conf.get('segment_records', 10000), indexes,
+								self.conf.get('partition_seconds', 0), self.conf.get('max_partitions', 0),
+								self.conf.get('compress_level', 0), self.conf.get('block_records', 256),
+								self.executor)
+			self.add_farm(name, table)
+		elif self.backend == 'sqlite':
+			table = SQLiteTable(self.db, name, key_field, indexes)
+		elif self.lazy(name):
+			filename = self.store_filename(name)
+			future = self.executor.submit(self.load_table, name, filename, key_field, indexes)
+			table = LazyTable(name, key_field, future, self.loaded)
+			self.loading[filename] = table
+		else:
+			store = self.store(name)
+			table = store.table(name, key_field, indexes)
+			if store is not self.db:
+				self.migrate(name, table)
+			self.add_farm(name, table)
+		if self.writer is not None:
+			table = WriteBehindTable(table, self.writer)
 		self.db_tables[name] = table
 		return table
 
@@ -268,15 +730,90 @@ class DB:
 
 	def close(self):
 		logger.info("%s closing DB", self.name)
-		for tab in self.db_tables:
+		for tab in list(self.db_tables):
 			try:
 				self.db_tables[tab].close()
 				del self.db_tables[tab]
 			except:
 				pass
-		self.db.close()
+		if self.writer is not None:
+			self.writer.stop()
+		if self.backend == 'sqlite':
+			self.db.close()
+		for filename in self.stores:
+			self.stores[filename].close()
+		self.stores = {}
 		self.db = None
+		self.executor.shutdown()
 
 
 	def flush(self):
-		self.db._storage.flush()
+		for tab in self.db_tables:
+			self.db_tables[tab].flush()
+		if self.writer is not None:
+			self.writer.submit_io(self.flush_db)
+		else:
+			self.flush_db()
+
+
+	async def caught_up(self):
+		""" wait, without blocking the event loop, until the DBWriter applied the mutations submitted so far """
+		if self.writer is None or self.writer.applied >= self.writer.seqno:
+			return
+		await asyncio.get_event_loop().run_in_executor(None, self.writer.wait, self.writer.seqno)
+
+
+	def write_journals(self):
+		""" write the journals on their fsync cadence, in the DBWriter after each mutation """
+		for store in list(self.stores.values()):
+			store.write_out()
+
+
+	def flush_db(self):
+		""" with write_behind this runs in the DBWriter, without its lock """
+		if self.backend == 'sqlite':
+			if self.writer is not None:
+				with self.writer.lock:  # the connection is shared with the readers
+					self.db.commit()
+			else:
+				self.db.commit()
+			return
+		now = time.time()
+		for filename in self.stores:
+			store = self.stores[filename]
+			if now - store.last_flush >= store.flush_interval:
+				store.flush()
+			elif store.unsynced > 0 and 0 <= store.fsync_interval <= now - store.last_sync:
+				store.sync()
+
+
+	def add_farm(self, name, table):
+		""" apply the index budget of conf to the DBIndexFarm of a table """
+		farm = table.restrict_idxs
+		farm.max_indexes = self.conf.get('index_max', INDEX_MAX)
+		farm.max_keys = self.conf.get('index_max_keys', INDEX_MAX_KEYS)
+		self.farms[name] = farm
+
+
+	def hold_index(self, name, csk, delta=1):
+		""" count a CSearch on table name that uses the index of csk, see DBIndexFarm.hold """
+		farm = self.farms.get(name)
+		if farm is None:  # sqlite, or not loaded yet
+			return
+		if self.writer is not None:
+			with self.writer.lock:
+				farm.hold(csk, delta)
+		else:
+			farm.hold(csk, delta)
+
+
+	def index_stats(self):
+		""" DBIndexFarm.stats() per table """
+		return {name: self.farms[name].stats() for name in list(self.farms)}
+
+
+	def status(self):
+		""" DBWriter queue depth and lag, empty without write_behind """
+		if self.writer is None:
+			return {}
+		return self.writer.status()
@@ -0,0 +1,644 @@
+# python library Steamlink
+
+import logging
+from collections import OrderedDict
+
+from sortedcontainers import SortedList
+
+from . import (DBG, DBGK)
+from .query import Query
+
+logger = logging.getLogger()
+
+INDEX_MAX = 64  # indexes per table
+INDEX_MAX_KEYS = 1000000  # keys in all indexes of a table
+
+
+#
+# DBIndex
+#
+class DBIndex:
+	""" keys of the records of a table that match the restrictions of a
+		CSearchKey, sorted by key_field, with positional access in O(log n)
+		- only keys are held, records are looked up in the table by key when
+		  they are read, so a record is held once, by the table
+		- for a key_field other than the table key, refs maps a key_field
+		  value to the table key of its record
+	"""
+
+
+	def __init__(self, recs, key_field, restrict_by, lookup, table_key, keys=None):
+		""" lookup(key) returns the record with table key table_key == key
+			keys are the matching keys if they are known, e.g. for a saved
+			index, otherwise recs are scanned
+		"""
+		self.key_field = key_field
+		self.restrict_by = restrict_by
+		self.query = Query.from_restrictions(restrict_by)
+		self.lookup = lookup
+		self.table_key = table_key
+		self.refs = None if key_field == table_key else {}
+		if keys is None:
+			refs = {}
+			for item in recs:
+				if self.query.match(item):
+					refs[item[key_field]] = item[table_key]
+			keys = refs.keys()
+			if self.refs is not None:
+				self.refs = refs
+		self.sorted_keys = SortedList(keys)
+		if 'dbops' in DBGK: logger.debug("DBIndex __init__ %s %s: %s", key_field, restrict_by, len(self))
+
+
+	def __len__(self):
+		return len(self.sorted_keys)
+
+
+	def __contains__(self, key):
+		return key in self.sorted_keys
+
+
+	def has(self, key):
+		return key in self
+
+
+	def keys(self):
+		return self.sorted_keys
+
+
+	def table_key_of(self, key):
+		return self.refs[key] if self.refs is not None else key
+
+
+	def record(self, key):
+		return self.lookup(self.table_key_of(key))
+
+
+	def add(self, item):
+		key = item[self.key_field]
+		if self.refs is not None:
+			self.refs[key] = item[self.table_key]
+		if key not in self.sorted_keys:
+			self.sorted_keys.add(key)
+
+
+	def db_update(self, item):  # N.B. handle change of key value
+		if self.query.match(item):
+			self.add(item)
+		else:
+			self.db_delete(item)
+
+
+	def db_insert(self, item):
+		if self.query.match(item):
+			self.add(item)
+
+
+	def db_delete(self, item):
+		key = item[self.key_field]
+		self.sorted_keys.discard(key)
+		if self.refs is not None:
+			self.refs.pop(key, None)
+
+
+	def rank(self, key, right=False):
+		""" number of keys < key (<= key if right) """
+		return self.sorted_keys.bisect_right(key) if right else self.sorted_keys.bisect_left(key)
+
+
+	def irange_op(self, op, value):
+		""" keys k of the index for which 'k op value' holds """
+		if op == '<':
+			return self.sorted_keys.irange(maximum=value, inclusive=(True, False))
+		if op == '<=':
+			return self.sorted_keys.irange(maximum=value)
+		if op == '>':
+			return self.sorted_keys.irange(minimum=value, inclusive=(False, True))
+		return self.sorted_keys.irange(minimum=value)
+
+
+	def get_range(self, csk):
+		""" return the records of this index in the range of a CSearchKey,
+		update csk with the actual range
+		"""
+		if 'get_range' in DBGK: logger.debug("get_range csk %s", str(csk))
+		startv = csk.start_key
+		endv = csk.end_key
+		count = csk.count
+
+		csk.total_item_count = 0
+
+		size = len(self)
+		if size == 0:
+			if 'get_range' in DBGK: logger.debug("get_range table empty after destrict")
+			return {}
+
+		if csk.cursor_dir is not None:
+			page = csk.cursor_page(self.rank, size)
+			if page is None:
+				if 'get_range' in DBGK: logger.debug("get_range nothing %s the cursor", csk.cursor_dir)
+				return {}
+			sidx, eidx = page
+			count = eidx - sidx + 1
+		else:
+			if startv in [None]:
+				if csk.start_item_number < 0:
+					sidx = max(0, size + csk.start_item_number)
+				else:
+					sidx = min(csk.start_item_number, size - 1)
+			else:
+				sidx = self.sorted_keys.bisect_left(startv)
+				if sidx == size:
+					if 'get_range' in DBGK: logger.debug("get_range no start key found")
+					return {}
+
+			if endv in [None]:
+				eidx = min(sidx + count - 1, size - 1)
+			else:
+				eidx = max(self.sorted_keys.bisect_right(endv), sidx) - 1
+				if eidx < 0:
+					if 'get_range' in DBGK: logger.debug("get_range no end key found")
+					return {}
+				count = eidx - sidx + 1
+
+		csk.start_key = self.sorted_keys[sidx]
+		csk.end_key = self.sorted_keys[eidx]
+		csk.start_item_number = sidx
+		csk.count = count
+		csk.total_item_count = size
+		csk.at_start = sidx == 0
+		csk.at_end = eidx == size - 1
+		csk.set_cursors()
+
+		if 'get_range' in DBGK: logger.debug("get_range size %s", (eidx - sidx + 1))
+		for key in self.sorted_keys.islice(sidx, eidx + 1):
+			yield self.record(key)
+
+
+#
+# DBCompositeIndex
+#
+class DBCompositeIndex:
+	""" (field, key) pairs of all records of a table, sorted, where key is
+		the table key, e.g. (slid, ts) for Packet
+		- the records with field == value are a contiguous run, found by
+		  bisection, view(value) is the DBIndex for 'field == value' over it
+		- an insert adds one pair, whatever the value of field
+		- built on first use, by one pass over the table
+	"""
+
+
+	def __init__(self, recs, field, key_field, pairs=None):
+		self.field = field
+		self.key_field = key_field
+		if pairs is None:
+			pairs = [(item[field], item[key_field]) for item in recs if field in item]
+		self.pairs = SortedList(pairs)
+		if 'dbops' in DBGK: logger.debug("DBCompositeIndex __init__ %s %s: %s", field, key_field, len(self))
+
+
+	def __len__(self):
+		return len(self.pairs)
+
+
+	def pair(self, item):
+		return (item[self.field], item[self.key_field]) if self.field in item else None
+
+
+	def db_insert(self, item):
+		pair = self.pair(item)
+		if pair is not None:
+			self.pairs.add(pair)
+
+
+	def db_update(self, item):
+		""" O(log n), unless the value of field changed, which takes a scan """
+		pair = self.pair(item)
+		if pair is None or pair in self.pairs:
+			return
+		key = item[self.key_field]
+		for old in [p for p in self.pairs if p[1] == key]:
+			self.pairs.remove(old)
+		self.pairs.add(pair)
+
+
+	def db_delete(self, item):
+		pair = self.pair(item)
+		if pair is not None:
+			self.pairs.discard(pair)
+
+
+	def view(self, value, restrict_by, lookup):
+		idx = DBIndex.__new__(DBIndex)
+		idx.key_field = self.key_field
+		idx.restrict_by = restrict_by
+		idx.query = Query.from_restrictions(restrict_by)
+		idx.lookup = lookup
+		idx.table_key = self.key_field
+		idx.refs = None
+		idx.sorted_keys = CompositeKeys(self.pairs, value)
+		return idx
+
+
+#
+# TopKey
+#
+class TopKey:
+	""" compares greater than any key """
+
+
+	def __lt__(self, other):
+		return False
+
+
+	def __le__(self, other):
+		return other is self
+
+
+	def __gt__(self, other):
+		return other is not self
+
+
+	def __ge__(self, other):
+		return True
+
+
+TOP_KEY = TopKey()
+
+
+#
+# CompositeKeys
+#
+class CompositeKeys:
+	""" the keys of the pairs (value, key) of a SortedList, as a read-only
+		SortedList of keys
+	"""
+
+
+	def __init__(self, pairs, value):
+		self.pairs = pairs
+		self.value = value
+
+
+	def bounds(self):
+		return self.pairs.bisect_left((self.value,)), self.pairs.bisect_right((self.value, TOP_KEY))
+
+
+	def __len__(self):
+		lo, hi = self.bounds()
+		return hi - lo
+
+
+	def __contains__(self, key):
+		return (self.value, key) in self.pairs
+
+
+	def __getitem__(self, pos):
+		lo, hi = self.bounds()
+		pos = pos + hi if pos < 0 else pos + lo
+		if pos < lo or pos >= hi:
+			raise IndexError("CompositeKeys index out of range")
+		return self.pairs[pos][1]
+
+
+	def __iter__(self):
+		return self.irange()
+
+
+	def bisect_left(self, key):
+		return self.pairs.bisect_left((self.value, key)) - self.bounds()[0]
+
+
+	def bisect_right(self, key):
+		return self.pairs.bisect_right((self.value, key)) - self.bounds()[0]
+
+
+	def islice(self, start=None, stop=None):
+		lo, hi = self.bounds()
+		start = lo if start is None else min(lo + start, hi)
+		stop = hi if stop is None else min(lo + stop, hi)
+		return (pair[1] for pair in self.pairs.islice(start, stop))
+
+
+	def irange(self, minimum=None, maximum=None, inclusive=(True, True)):
+		lo = (self.value,) if minimum is None else (self.value, minimum)
+		hi = (self.value, TOP_KEY) if maximum is None else (self.value, maximum)
+		inclusive = (inclusive[0] or minimum is None, inclusive[1])
+		return (pair[1] for pair in self.pairs.irange(lo, hi, inclusive))
+
+
+#
+# DBIndexFarm
+#
+class DBIndexFarm(OrderedDict):
+	""" the DBIndexes of a table, by CSearchKey name
+		- indexes hold keys, memory grows with the matches, not with the
+		  number of indexes times the table size
+		- indexes on 'field == value' are found by a dict lookup on the value
+		  of an inserted record, other indexes evaluate their restrictions
+		- indexes are held by the CSearches that use them, see hold(); when
+		  the indexes that are not held are more than max_indexes, or have
+		  more than max_keys keys in all, the least recently used of them are
+		  evicted; held indexes are not counted, e.g. the table key index
+		  retention holds
+		- for a composite (field, key_field), 'field == value' indexes on
+		  key_field are views of one DBCompositeIndex, they are not built,
+		  kept or evicted
+	"""
+
+
+	def __init__(self, table, key_field, lookup, composites=()):
+		""" lookup(key) returns the record with table key key_field == key
+			composites lists (field, key_field) pairs, key_field must be the table key
+		"""
+		self.table = table
+		self.key_field = key_field
+		self.lookup = lookup
+		self.composites = {}  # field -> DBCompositeIndex, None until used
+		for field, comp_key in composites:
+			if comp_key != key_field:
+				logger.error("DBIndexFarm: composite index (%s, %s) does not end in the table key %s",
+							 field, comp_key, key_field)
+				continue
+			self.composites[field] = None
+		self.eq_idxs = {}  # (key_field, field) -> {value: DBIndex}
+		self.other_idxs = []
+		self.max_indexes = INDEX_MAX
+		self.max_keys = INDEX_MAX_KEYS
+		self.refs = {}  # name -> number of holders
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		super().__init__()
+
+
+	@staticmethod
+	def mk_restrict_idx_name(restrict_by):
+		name = ""
+		for restrict in restrict_by:
+			name += "%s%s%s" % (restrict['field_name'], restrict['op'], restrict['value'])
+		return name
+
+
+	def idx_name(self, csk):
+		return csk.key_field + self.mk_restrict_idx_name(csk.restrict_by)
+
+
+	def sorted_idx(self, field, build=False, hold=False):
+		""" the unrestricted DBIndex on field, None if it does not exist and build is not set
+			if hold is set, the index is held for good, as by a CSearch that is never closed
+		"""
+		idx = self.get(field)
+		if idx is None and build:
+			self.misses += 1
+			idx = self.add_idx(field, [])
+			self.evict(keep=field)
+		if idx is not None and hold:
+			self.refs.setdefault(field, 1)
+		return idx
+
+
+	def sorted_fields(self):
+		""" fields whose unrestricted DBIndex has every record, for the QueryPlanner
+			only the table key: an index on another field keeps one table key
+			per value, see refs
+		"""
+		return [self.key_field] if self.key_field in self else []
+
+
+	def add_idx(self, key_field, restrict_by, keys=None):
+		restrict_name = key_field + self.mk_restrict_idx_name(restrict_by)
+		idx = DBIndex(self.table, key_field, restrict_by, self.lookup, self.key_field, keys)
+		preds = idx.query.preds
+		try:
+			if len(preds) != 1 or preds[0].op != '==':
+				raise TypeError
+			self.eq_idxs.setdefault((key_field, preds[0].field), {})[preds[0].value] = idx
+		except TypeError:  # not a single '==', or an unhashable value
+			self.other_idxs.append(idx)
+		self[restrict_name] = idx
+		return idx
+
+
+	def composite(self, field):
+		""" the DBCompositeIndex on (field, table key), built if needed """
+		if self.composites[field] is None:
+			logger.info("DBIndexFarm: building composite index (%s, %s)", field, self.key_field)
+			self.composites[field] = DBCompositeIndex(self.table, field, self.key_field)
+		return self.composites[field]
+
+
+	def composite_view(self, csk):
+		""" the view of a composite index that serves csk, None if there is none """
+		if csk.key_field != self.key_field or len(csk.restrict_by) != 1:
+			return None
+		restrict = csk.restrict_by[0]
+		if restrict['op'] != '==' or restrict['field_name'] not in self.composites:
+			return None
+		comp = self.composite(restrict['field_name'])
+		try:
+			comp.pairs.bisect_left((restrict['value'],))
+		except TypeError:  # value of another type than field's
+			return None
+		return comp.view(restrict['value'], csk.restrict_by, self.lookup)
+
+
+	def get_idx(self, csk):
+		restrict_name = self.idx_name(csk)
+		if 'dbops' in DBGK: logger.debug("DBIndexFarm get name '%s'", restrict_name)
+		view = self.composite_view(csk)
+		if view is not None:
+			self.hits += 1
+			return view
+		if restrict_name in self:
+			self.hits += 1
+			self.move_to_end(restrict_name)
+			return self[restrict_name]
+		self.misses += 1
+		idx = self.add_idx(csk.key_field, csk.restrict_by)
+		self.evict(keep=restrict_name)
+		return idx
+
+
+	def hold(self, csk, delta=1):
+		""" count a CSearch that uses the index of csk, a negative delta releases it """
+		name = self.idx_name(csk)
+		refs = max(0, self.refs.get(name, 0) + delta)
+		if refs == 0:
+			self.refs.pop(name, None)
+			self.evict()
+		else:
+			self.refs[name] = refs
+
+
+	def key_count(self, names=None):
+		""" keys in the indexes names, default all """
+		return sum(len(self[name]) for name in (self if names is None else names))
+
+
+	def in_use(self):
+		""" true if deletes need to be applied: there are DBIndexes, or built composite indexes """
+		return len(self) > 0 or any(comp is not None for comp in self.composites.values())
+
+
+	def evict(self, keep=None):
+		""" drop least recently used indexes that are not held, while those are over budget """
+		while True:
+			unheld = [name for name in self if name not in self.refs]
+			if len(unheld) <= self.max_indexes and self.key_count(unheld) <= self.max_keys:
+				break
+			name = next((name for name in unheld if name != keep), None)
+			if name is None:
+				break
+			self.remove(name)
+			self.evictions += 1
+
+
+	def remove(self, name):
+		idx = self.pop(name)
+		if 'dbops' in DBGK: logger.debug("DBIndexFarm evicting '%s', %s keys", name, len(idx))
+		if idx in self.other_idxs:
+			self.other_idxs.remove(idx)
+			return
+		for fields in list(self.eq_idxs):
+			by_value = self.eq_idxs[fields]
+			for value in list(by_value):
+				if by_value[value] is idx:
+					del by_value[value]
+			if len(by_value) == 0:
+				del self.eq_idxs[fields]
+
+
+	def stats(self):
+		return {
+			'indexes':   len(self),
+			'keys':      self.key_count(),
+			'held':      len(self.refs),
+			'hits':      self.hits,
+			'misses':    self.misses,
+			'evictions': self.evictions,
+		}
+
+
+	def save(self):
+		""" the keys of the indexes on the table key, and the pairs of the
+			composite indexes, for restore()
+		"""
+		saved = [{'key_field': idx.key_field, 'restrict_by': idx.restrict_by, 'keys': list(idx.keys())}
+				 for idx in self.values() if idx.key_field == self.key_field]
+		for field, comp in self.composites.items():
+			if comp is not None:
+				saved.append({'composite': field, 'pairs': list(comp.pairs)})
+		return saved
+
+
+	def restore(self, saved):
+		""" rebuild indexes from save(), the table is not scanned and restrictions are not evaluated """
+		for s in saved:
+			if 'composite' in s:
+				if s['composite'] in self.composites:
+					pairs = [tuple(pair) for pair in s['pairs']]
+					self.composites[s['composite']] = DBCompositeIndex(None, s['composite'], self.key_field, pairs)
+				continue
+			self.add_idx(s['key_field'], s['restrict_by'], s['keys'])
+		if 'dbops' in DBGK: logger.debug("DBIndexFarm restored %s", list(self))
+
+
+	def insert_idxs(self, item):
+		""" add item to the indexes it matches """
+		for (key_field, field), by_value in self.eq_idxs.items():
+			if field not in item:
+				continue
+			try:
+				idx = by_value.get(item.get(field))
+			except TypeError:
+				continue
+			if idx is not None and key_field in item:
+				idx.add(item)
+		for idx in self.other_idxs:
+			idx.db_insert(item)
+		for comp in self.composites.values():
+			if comp is not None:
+				comp.db_insert(item)
+
+
+	def db_update(self, item):
+		for idx in self.values():
+			idx.db_update(item)
+		for comp in self.composites.values():
+			if comp is not None:
+				comp.db_update(item)
+
+
+	def db_insert(self, item):
+		self.insert_idxs(item)
+
+
+	def insert_many(self, items):
+		for item in items:
+			self.insert_idxs(item)
+
+
+	def update_many(self, items):
+		for item in items:
+			self.db_update(item)
+
+
+	def db_delete(self, item):
+		if 'dbops' in DBGK: logger.debug("DBIndexFarm  deleting item %s", item)
+		for idx in self.values():
+			idx.db_delete(item)
+		for comp in self.composites.values():
+			if comp is not None:
+				comp.db_delete(item)
+
+
+	def delete_many(self, items):
+		for item in items:
+			self.db_delete(item)
+
+
+#
+# DBFieldIndex
+#
+class DBFieldIndex(dict):
+	""" secondary index, maps a field value to the keys of the records with that value
+		the keys for a value are kept in insertion order
+	"""
+
+
+	def __init__(self, field, key_field, recs=()):
+		self.field = field
+		self.key_field = key_field
+		super().__init__()
+		for rec in recs:
+			self.db_insert(rec)
+
+
+	def lookup(self, val):
+		""" keys of records with field == val """
+		return list(self.get(val, ()))
+
+
+	def db_insert(self, rec):
+		if self.field not in rec:
+			return
+		self.setdefault(rec[self.field], {})[rec[self.key_field]] = None
+
+
+	def db_update(self, old, new):
+		if old.get(self.field) != new.get(self.field) or self.field not in old:
+			self.db_delete(old)
+			self.db_insert(new)
+
+
+	def db_delete(self, rec):
+		if self.field not in rec:
+			return
+		val = rec[self.field]
+		keys = self.get(val)
+		if keys is None:
+			return
+		keys.pop(rec[self.key_field], None)
+		if len(keys) == 0:
+			del self[val]
@@ -15,6 +15,8 @@ function Stream(sock, config, on_new_message) {
   start_item_number
   count
   end_key
+  cursor - next_cursor or prev_cursor of the last ack, pages from
+           there by key instead of by position
 
   ******/
 
@@ -35,6 +37,7 @@ function Stream(sock, config, on_new_message) {
       start_item_number: self.config.start_item_number,
       count: self.config.count,
       end_key: self.config.end_key,
+      cursor: self.config.cursor,
       stream_tag: self.config.stream_tag
     }, function (data){ // on ack
       if (data.error) {
@@ -47,6 +50,8 @@ function Stream(sock, config, on_new_message) {
         self.config.count = data.count;
         self.config.start_item_number = data.start_item_number;
         self.config.total_item_count = data.total_item_count;
+        self.config.next_cursor = data.next_cursor;
+        self.config.prev_cursor = data.prev_cursor;
       }
     });
   };
@@ -65,6 +70,7 @@ function Stream(sock, config, on_new_message) {
       start_item_number: self.config.start_item_number,
       count: self.config.count,
       end_key: self.config.end_key,
+      cursor: self.config.cursor,
       stream_tag: self.config.stream_tag
     }, function (data){ // on ack
       if (data.error) {
@@ -77,6 +83,8 @@ function Stream(sock, config, on_new_message) {
         self.config.count = data.count;
         self.config.start_item_number = data.start_item_number;
         self.config.total_item_count = data.total_item_count;
+        self.config.next_cursor = data.next_cursor;
+        self.config.prev_cursor = data.prev_cursor;
       }
     });
   };
@@ -136,6 +144,18 @@ function Stream(sock, config, on_new_message) {
   sock.on(self.config.stream_tag, self.newStreamData);
 }
 
+// aggregate computed by the server, e.g. packets per node in the last 24h:
+// aggregate(sock, {table_name: "Packet", since: 86400, aggs: [["count"]], group_by: "slid"}, on_rows)
+function aggregate(sock, query, on_rows) {
+  sock.emit("aggregate", query, function (data) {
+    if (data.error) {
+      console.log("Err: " + data.error);
+    } else {
+      on_rows(data.rows);
+    }
+  });
+}
+
 // On Document Ready
 $(function() {
   // Setup socket.io
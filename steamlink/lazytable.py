@@ -0,0 +1,175 @@
+# python library Steamlink
+
+import logging
+import time
+
+from . import (DBG, DBGK)
+from .query import Query, Aggregation
+
+logger = logging.getLogger()
+
+
+#
+# LazyTable
+#
+class LazyTable:
+	""" DBTable interface for a table keyed by time stamp that is loaded in
+		the background, e.g. Packet and LogItem
+		- writes, and delete_before, before the load completes are queued, and
+		  applied in order once it is done
+		- reads never wait for the load, until it completes they are answered
+		  from the records written since it started: get, search, aggregate
+		  and key_at see only those, get_range yields nothing, size_bytes is 0
+		- len() is approximate until the load completes
+		- close waits for the load
+	"""
+
+
+	def __init__(self, name, key_field, future, on_load=None):
+		""" future gives the table, on_load(table) is called once it is in use """
+		self.name = name
+		self.key_field = key_field
+		self.future = future
+		self.on_load = on_load
+		self.started = time.time()
+		self.pending = []  # (method name, args)
+		self.table = None
+
+
+	def ready(self):
+		return self.table is not None or self.future.done()
+
+
+	def loaded(self):
+		""" the table, waiting for the load and applying the queued writes
+			call it on the event loop only once ready()
+		"""
+		if self.table is None:
+			table = self.future.result()
+			if self.on_load is not None:
+				self.on_load(table)
+			for fn, args in self.pending:
+				getattr(table, fn)(*args)
+			if 'dbops' in DBGK: logger.debug("LazyTable %s: loaded, %s writes applied", self.name, len(self.pending))
+			self.pending = []
+			self.table = table
+		return self.table
+
+
+	def write(self, fn, *args):
+		if self.ready():
+			getattr(self.loaded(), fn)(*args)
+		else:
+			self.pending.append((fn, args))
+
+
+	def db_insert(self, rec):
+		self.write('db_insert', dict(rec))
+
+
+	def db_update(self, rec):
+		self.write('db_update', dict(rec))
+
+
+	def db_delete(self, rec):
+		self.write('db_delete', dict(rec))
+
+
+	def insert_many(self, recs):
+		self.write('insert_many', [dict(rec) for rec in recs])
+
+
+	def update_many(self, recs):
+		self.write('update_many', [dict(rec) for rec in recs])
+
+
+	def written(self):
+		""" the records written since the load started, by key, from the queue """
+		recs = {}
+		for fn, args in self.pending:
+			if fn == 'delete_before':
+				key, inclusive = args
+				for k in [k for k in recs if k < key or (inclusive and k == key)]:
+					del recs[k]
+				continue
+			for rec in args[0] if fn in ['insert_many', 'update_many'] else [args[0]]:
+				k = rec[self.key_field]
+				if fn in ['db_insert', 'insert_many'] and k not in recs:
+					recs[k] = dict(rec)
+				elif fn in ['db_update', 'update_many'] and k in recs:
+					recs[k].update(rec)
+				elif fn == 'db_delete':
+					recs.pop(k, None)
+		return recs
+
+
+	def get(self, field, op, val):
+		if self.ready():
+			return self.loaded().get(field, op, val)
+		return next(iter(self.search(field, op, val)), None)
+
+
+	def search(self, field, op, val):
+		if self.ready():
+			return self.loaded().search(field, op, val)
+		query = Query.where(field, op, val)
+		return [rec for rec in self.written().values() if query.match(rec)]
+
+
+	def get_range(self, csk):
+		if not self.ready():
+			if 'dbops' in DBGK: logger.debug("LazyTable %s: get_range before the load completed", self.name)
+			return
+		yield from self.loaded().get_range(csk)
+
+
+	def aggregate(self, query, aggs, group_by=None):
+		if self.ready():
+			return self.loaded().aggregate(query, aggs, group_by)
+		return Aggregation(aggs, group_by).add_many(rec for rec in self.written().values() if query.match(rec)).rows()
+
+
+	def key_at(self, pos):
+		if self.ready():
+			return self.loaded().key_at(pos)
+		keys = sorted(self.written())
+		return keys[pos] if pos < len(keys) else None
+
+
+	def delete_before(self, key, inclusive=False):
+		""" the number of records deleted, 0 if the delete is queued """
+		if self.ready():
+			return self.loaded().delete_before(key, inclusive)
+		self.pending.append(('delete_before', (key, inclusive)))
+		return 0
+
+
+	def size_bytes(self):
+		if self.ready():
+			return self.loaded().size_bytes()
+		return 0
+
+
+	def flush(self):
+		""" the queued writes go to the table on the first flush after the load """
+		if self.ready():
+			self.loaded().flush()
+
+
+	def close(self):
+		""" waits for the load, at shutdown """
+		if not self.ready():
+			logger.info("LazyTable %s: waiting for load", self.name)
+		self.loaded()
+
+
+	def __len__(self):
+		if self.ready():
+			return len(self.loaded())
+		count = 0
+		for fn, args in self.pending:
+			if fn == 'db_insert':
+				count += 1
+			elif fn == 'insert_many':
+				count += len(args[0])
+		return count
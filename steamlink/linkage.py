@@ -1,4 +1,7 @@
 import asyncio
+import base64
+import bisect
+import json
 import logging
 import re
 import sys
@@ -7,6 +10,7 @@ from asyncio import Queue
 from collections import OrderedDict
 
 from . import (DBG, DBGK)
+from .query import Query, Aggregation
 
 logger = logging.getLogger()
 
@@ -14,6 +18,9 @@ logger = logging.getLogger()
 _WEBAPP = None
 _DB = None
 
+BATCH_WAIT = 0.05  # seconds insert_batched waits for more items
+BATCH_MAX = 1000  # items after which insert_batched writes at once
+
 
 def Attach(webapp, db):
 	global _WEBAPP, _DB
@@ -36,8 +43,16 @@ def Attach(webapp, db):
 
 
 class CSearchKey:
+	""" a range of a table, by start_key or start_item_number and count,
+		or by cursor, as returned in next_cursor and prev_cursor by the last
+		get_range; a cursor is the key a page ends at and a direction, the
+		range is the count records after ('next') or before ('prev') that
+		key, found in O(log n) and not shifted by inserts
+	"""
+
+
 	def __init__(self, table_name, key_field, start_key, start_item_number,
-				 count, stream_tag="NoTag", end_key=None, restrict_by=None):
+				 count, stream_tag="NoTag", end_key=None, restrict_by=None, cursor=None):
 
 		self.table_name = table_name
 		self.key_field = key_field
@@ -58,26 +73,58 @@ class CSearchKey:
 			self.restrict_by = []
 		else:
 			self.restrict_by = restrict_by
+		self.restrict_query = Query.from_restrictions(self.restrict_by)
+
+		self.cursor = cursor
+		self.cursor_dir = None  # 'next' or 'prev'
+		self.cursor_key = None
+		if cursor is not None:
+			try:
+				self.cursor_dir, self.cursor_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+				if self.cursor_dir not in ['next', 'prev']:
+					raise ValueError("direction '%s'" % self.cursor_dir)
+			except (ValueError, TypeError, AttributeError) as e:
+				logger.warning("CSearchKey: ignoring cursor %s: %s", cursor, e)
+				self.cursor = self.cursor_dir = self.cursor_key = None
+		self.next_cursor = None
+		self.prev_cursor = None
 		self.search_id = self.__repr__()  # used to index CSearches
 
 
+	@staticmethod
+	def make_cursor(key, direction):
+		return base64.urlsafe_b64encode(json.dumps([direction, key]).encode('utf-8')).decode('ascii')
+
+
+	def set_cursors(self):
+		""" cursors for the pages after and before the current range """
+		self.next_cursor = self.make_cursor(self.end_key, 'next')
+		self.prev_cursor = self.make_cursor(self.start_key, 'prev')
+
+
+	def cursor_page(self, rank, size):
+		""" positions (first, last) of the page at the cursor, None if it is empty
+			rank(key, right) is the number of keys < key (<= key if right)
+		"""
+		if self.cursor_dir == 'next':
+			sidx = rank(self.cursor_key, True)
+			eidx = min(sidx + self.count, size) - 1
+		else:
+			eidx = rank(self.cursor_key, False) - 1
+			sidx = max(0, eidx - self.count + 1)
+		if sidx > eidx:
+			return None
+		return sidx, eidx
+
+
 	def check_restrictions(self, item):
-		if len(self.restrict_by) == 0:
-			return True
-		res = True
-		for restrict in self.restrict_by:
-			field = restrict['field_name']
-			op = restrict['op']
-			value = restrict['value']
-			ex = "item['%s'] %s %s" % (field, op, repr(value))
-			res = res and eval(ex)
-		return res
+		return self.restrict_query.match(item)
 
 
 	def __repr__(self):
-		return "%s(%s:%s:%s)_%s_%s_%s" % \
+		return "%s(%s:%s:%s)_%s_%s_%s_%s" % \
 			   (self.table_name, self.key_field, self.start_key, self.end_key,
-				self.restrict_by, self.start_item_number, self.stream_tag)
+				self.restrict_by, self.start_item_number, self.cursor, self.stream_tag)
 
 
 	def __str__(self):
@@ -157,12 +204,40 @@ class CSearch:
 		# find csitem for item
 		if 'csearch' in DBGK: logger.debug("check_csearch (CSearch) %s force=%s op=%s item=%s",
 										   self, force, op, item)
-		item_search_key = item.__dict__[self.csearchkey.key_field]
-		push = False
 		go = self.csearchkey.check_restrictions(item.__dict__)
 		if not go:
 			return
 
+		push = self.apply_item(op, item)
+		if push or force:
+			if 'csearch' in DBGK: logger.debug("check_csearch (push) %s force=%s", self, force)
+			item_search_key = item.__dict__[self.csearchkey.key_field]
+			try:
+				self.cs_items[item_search_key].push_update(force)
+			except KeyError as e:
+				logger.error("check_csearch (push) keyerror: %s", e)
+		return
+
+
+	def check_csearch_many(self, op, items):
+		""" check_csearch for a batch of items, the matching items are
+			pushed to the clients in one update
+		"""
+		if 'csearch' in DBGK: logger.debug("check_csearch_many (CSearch) %s op=%s %s items", self, op, len(items))
+		cs_list = []
+		for item in items:
+			if self.csearchkey.check_restrictions(item.__dict__) and self.apply_item(op, item):
+				csitem = self.cs_items.get(item.__dict__[self.csearchkey.key_field])
+				if csitem is not None:
+					cs_list.append(csitem)
+		if len(cs_list) > 0 and _WEBAPP is not None:
+			_WEBAPP.queue_itemlist_update(cs_list, False)
+
+
+	def apply_item(self, op, item):
+		""" add or drop item in cs_items, return True if clients need an update """
+		item_search_key = item.__dict__[self.csearchkey.key_field]
+		push = False
 		if item_search_key not in self.cs_items:
 			if op in ['ins']:
 				if self.csearchkey.at_end \
@@ -185,14 +260,7 @@ class CSearch:
 				self.drop_item(item)
 
 			push = True
-
-		if push or force:
-			if 'csearch' in DBGK: logger.debug("check_csearch (push) %s force=%s", self, force)
-			try:
-				self.cs_items[item_search_key].push_update(force)
-			except KeyError as e:
-				logger.error("check_csearch (push) keyerror: %s", e)
-		return
+		return push
 
 
 	def force_update(self, sid):
@@ -330,20 +398,29 @@ class OCache(dict):
 			self.warned = False
 
 
+	def set_many(self, items):
+		""" set a batch of (key, value), the cache is cleaned once for the batch """
+		now = time.time()
+		for key, value in items:
+			if key in self:
+				self.replaces += 1
+			super().__setitem__(key, value)
+			self.sets += 1
+			self.ts[key] = now
+		if 'ocache' in DBGK: logger.debug("OCache %s set_many %s items", self.tablename, len(items))
+		if len(self) > self.max_entries:
+			self.clean()
+		else:
+			self.warned = False
+
+
 	def clean(self):
 		if 'ocache' in DBGK: logger.debug("OCache %s clean!", self.tablename)
-		#		to_prune =  len(self) - self.max_entries
-		to_prune = int(self.max_entries / 10)
-		for p in range(to_prune):
-			ts = time.time()
-			d = None
-			for i in self.keys():
-				if sys.getrefcount(super().__getitem__(i)) == 2:  # N.B sys.getrefcount and  self[i]
-					if ts > self.ts[i]:
-						d = i
-						ts = self.ts[i]
-			if d is None:
-				break
+		to_prune = max(int(self.max_entries / 10), len(self) - self.max_entries)
+		unused = [i for i in self.keys()
+				  if sys.getrefcount(dict.__getitem__(self, i)) == 2]  # N.B sys.getrefcount and  self[i]
+		unused.sort(key=self.ts.__getitem__)
+		for d in unused[:to_prune]:
 			del self[d]
 			del self.ts[d]
 
@@ -392,6 +469,7 @@ class Table:
 		if srch_id not in self.csearches:
 			if 'webupd' in DBGK: logger.debug("table add_csearch '%s' new: %s", srch_id, csearchkey)
 			self.csearches[srch_id] = CSearch(webnamespace, self, csearchkey)
+			self.hold_index(csearchkey, 1)
 		else:
 			if 'webupd' in DBGK: logger.debug("table add_csearch search_id '%s' from cache", srch_id)
 		csearchkey = self.csearches[srch_id].add_sid(sid)
@@ -410,6 +488,7 @@ class Table:
 			if 'webupd' in DBGK: logger.debug("table drop_stream_tag_from_csearch t %s", dc)
 			del self.csearches[dc].clients[sid]
 			if len(self.csearches[dc].clients) == 0:
+				self.hold_index(self.csearches[dc].csearchkey, -1)
 				del self.csearches[dc]
 
 
@@ -423,9 +502,15 @@ class Table:
 				del_list.append(cs)
 		for cs in del_list:
 			if 'webupd' in DBGK: logger.debug("table drop_sid_from_csearch csearch empty! '%s'", cs)
+			self.hold_index(self.csearches[cs].csearchkey, -1)
 			del self.csearches[cs]
 
 
+	def hold_index(self, csk, delta):
+		""" a CSearch on csk starts (delta 1) or stops (-1) using an index of the table """
+		pass
+
+
 	def register(self, item):
 		""" either load item from backing store, if it exists, or store it there """
 		pass
@@ -439,6 +524,11 @@ class Table:
 		pass
 
 
+	def aggregate(self, query, aggs, group_by=None):
+		""" the rows of an Aggregation over the records matching a Query """
+		pass
+
+
 	def insert(self, item):
 		self.check_csearch('ins', item, force=False)
 
@@ -451,12 +541,34 @@ class Table:
 		self.check_csearch('del', item, force=False)
 
 
+	def insert_many(self, items):
+		self.check_csearch_many('ins', items)
+
+
+	def update_many(self, items):
+		self.check_csearch_many('upd', items)
+
+
+	def delete_many(self, items):
+		self.check_csearch_many('del', items)
+
+
+	def insert_pending(self):
+		pass
+
+
 	def check_csearch(self, op, item, force):
 		for cs in self.csearches:
 			if 'webupd' in DBGK: logger.debug("check_csearch (Table) %s force=%s", cs, force)
 			self.csearches[cs].check_csearch(op, item, force)
 
 
+	def check_csearch_many(self, op, items):
+		for cs in self.csearches:
+			if 'webupd' in DBGK: logger.debug("check_csearch_many (Table) %s %s items", cs, len(items))
+			self.csearches[cs].check_csearch_many(op, items)
+
+
 #
 # DbBackedTable
 #
@@ -464,13 +576,21 @@ class DbBackedTable(Table):
 	""" database based Table """
 
 
-	def __init__(self, itemclass, keyfield, tablename):
+	def __init__(self, itemclass, keyfield, tablename, indexes=()):
+		""" indexes lists fields that find and find_one look up by index """
 		self.tablename = tablename
 		self.cache = OCache(tablename, 1000)
-		self.dbtable = _DB.table(self.tablename, keyfield)
+		self.dbtable = _DB.table(self.tablename, keyfield, indexes)
+		self.archive = None  # ColumnArchive of expired records, set by Retention
+		self.pending = []  # items waiting for insert_pending
+		self.pending_handle = None
 		super().__init__(itemclass, keyfield)
 
 
+	def hold_index(self, csk, delta):
+		_DB.hold_index(self.tablename, csk, delta)
+
+
 	def register(self, item):
 		""" backload item from db if it exists, otherwise insert in db """
 		if DBG > 2: logger.debug("register %s %s", self.tablename, item)
@@ -500,11 +620,62 @@ class DbBackedTable(Table):
 
 
 	def get_range(self, csk):
-		""" get a range of items, defined by a CSearch """
-		for item_dict in self.dbtable.get_range(csk):
+		""" get a range of items, defined by a CSearch
+			cursor pages continue into the archive, if there is one
+		"""
+		if self.archive is None or len(self.archive) == 0 or csk.cursor_dir is None:
+			recs = self.dbtable.get_range(csk)
+		else:
+			recs = self.archived_range(csk)
+		for item_dict in recs:
 			yield self.make_item_from_dict(item_dict)
 
 
+	def archived_range(self, csk):
+		""" the records of a cursor page over the archive followed by the table,
+			the archived records are older than the table's; positions and
+			total_item_count count all archived records, also with restrict_by
+		"""
+		count = csk.count
+		arecs = recs = []
+		if csk.cursor_dir == 'next':
+			arecs = self.archive.after(csk.cursor_key, count, csk.check_restrictions)
+			if len(arecs) < count:
+				csk.count = count - len(arecs)
+				recs = list(self.dbtable.get_range(csk))
+		else:
+			recs = list(self.dbtable.get_range(csk))
+			if len(recs) < count:
+				key = recs[0][self.keyfield] if len(recs) > 0 else csk.cursor_key
+				arecs = self.archive.before(key, count - len(recs), csk.check_restrictions)
+		csk.count = count
+		res = arecs + recs
+		if len(res) == 0:
+			return []
+
+		if len(recs) > 0:
+			table_total = csk.total_item_count
+			csk.start_item_number += len(self.archive)
+		else:
+			table_total = len(self.dbtable) if len(csk.restrict_by) == 0 else 0
+			csk.at_end = len(self.dbtable) == 0 or (csk.cursor_dir == 'next' and len(arecs) < count)
+		if len(arecs) > 0:
+			csk.start_item_number = self.archive.rank(arecs[0][self.keyfield])
+		csk.start_key = res[0][self.keyfield]
+		csk.end_key = res[-1][self.keyfield]
+		csk.total_item_count = len(self.archive) + table_total
+		csk.at_start = csk.start_item_number == 0
+		csk.set_cursors()
+		if 'webupd' in DBGK: logger.debug("archived_range %s: %s archived, %s in the table", csk, len(arecs), len(recs))
+		return res
+
+
+	def aggregate(self, query, aggs, group_by=None):
+		""" computed by the db on the records, no items are made """
+		self.insert_pending()
+		return self.dbtable.aggregate(query, aggs, group_by)
+
+
 	def find(self, key, keyfield=None):
 		if keyfield is None:
 			keyfield = self.keyfield
@@ -541,6 +712,74 @@ class DbBackedTable(Table):
 		super().insert(item)
 
 
+	def insert_many(self, items):
+		""" insert a batch of items, with one db write and one csearch update """
+		if len(items) == 0:
+			return
+		if 'webupd' in DBGK: logger.debug("insert_many (DBTable) %s %s items", self, len(items))
+		self.dbtable.insert_many([item.save() for item in items])
+		self.cache.set_many([(item.__dict__[self.keyfield], item) for item in items])
+		super().insert_many(items)
+
+
+	def update_many(self, items):
+		if len(items) == 0:
+			return
+		if 'webupd' in DBGK: logger.debug("update_many (DBTable) %s %s items", self, len(items))
+		self.dbtable.update_many([item.save() for item in items])
+		self.cache.set_many([(item.__dict__[self.keyfield], item) for item in items])
+		super().update_many(items)
+
+
+	def insert_batched(self, item):
+		""" queue item for insert_many, a burst of inserts is written as
+			one batch after BATCH_WAIT seconds or BATCH_MAX items
+			the item is in the cache, so find_one finds it before that
+		"""
+		self.pending.append(item)
+		self.cache[item.__dict__[self.keyfield]] = item
+		if len(self.pending) >= BATCH_MAX:
+			self.insert_pending()
+		elif self.pending_handle is None:
+			self.pending_handle = asyncio.get_event_loop().call_later(BATCH_WAIT, self.insert_pending)
+
+
+	def insert_pending(self):
+		""" write the items queued by insert_batched """
+		if self.pending_handle is not None:
+			self.pending_handle.cancel()
+			self.pending_handle = None
+		items = self.pending
+		self.pending = []
+		self.insert_many(items)
+
+
+	def delete_before(self, key, inclusive=False):
+		""" bulk delete the items with keyfield < key (<= key if inclusive) in the db,
+			return the number of deleted records, an asyncio future of it with write_behind
+		"""
+		keys = [k for k in list(self.cache.keys()) if k < key or (inclusive and k == key)]
+		items = [dict.__getitem__(self.cache, k) for k in keys]
+		super().delete_many(items)
+		for k in keys:
+			del self.cache[k]
+			self.cache.ts.pop(k, None)
+		count = self.dbtable.delete_before(key, inclusive)
+		if 'webupd' in DBGK: logger.debug("delete_before (DBTable) %s %s: %s", self, key, count)
+		return count
+
+
+	def delete_oldest(self, count):
+		""" bulk delete the count items with the lowest keyfield """
+		count = min(count, len(self.dbtable))
+		if count <= 0:
+			return 0
+		key = self.dbtable.key_at(count - 1)
+		if key is None:
+			return 0
+		return self.delete_before(key, inclusive=True)
+
+
 	def delete(self, item):
 		logger.debug("db backed deleting item %s", item)
 		#		if DBG >= 1: logger.debug("DbBackedTable delete %s", item)
@@ -610,36 +849,44 @@ class DictBackedTable(Table):
 			if DBG > 1: logger.debug("get_range table empty after destrict")
 			return {}
 
-		if startv in [None]:
-			if csk.start_item_number < 0:
-				sidx = max(0, len(sdict) + csk.start_item_number)
-			else:
-				sidx = min(csk.start_item_number, len(sdict) - 1)
-			startv = sdict[sidx]
-		else:
-			sidx = None
-			for idx in range(len(sdict)):
-				if sdict[idx] >= startv:
-					sidx = idx
-					startv = sdict[sidx]
-					break
-			if sidx is None:
-				if DBG > 1: logger.debug("get_range no start key found")
+		if csk.cursor_dir is not None:
+			page = csk.cursor_page(lambda key, right: (bisect.bisect_right if right else bisect.bisect_left)(sdict, key),
+								   len(sdict))
+			if page is None:
+				if DBG > 1: logger.debug("get_range nothing %s the cursor", csk.cursor_dir)
 				return {}
-		if endv in [None]:
-			eidx = min(sidx + count - 1, len(sdict) - 1)
-			endv = sdict[eidx]
+			sidx, eidx = page
 		else:
-			eidx = None
-			for idx in range(sidx, len(sdict)):
-				if sdict[idx] <= endv:
-					endv = sdict[idx]
-					eidx = idx
-					break
-			if eidx is None:
-				if DBG > 1: logger.debug("get_range no end key found")
-				return {}
-			count = eidx - sidx + 1
+			if startv in [None]:
+				if csk.start_item_number < 0:
+					sidx = max(0, len(sdict) + csk.start_item_number)
+				else:
+					sidx = min(csk.start_item_number, len(sdict) - 1)
+				startv = sdict[sidx]
+			else:
+				sidx = None
+				for idx in range(len(sdict)):
+					if sdict[idx] >= startv:
+						sidx = idx
+						startv = sdict[sidx]
+						break
+				if sidx is None:
+					if DBG > 1: logger.debug("get_range no start key found")
+					return {}
+			if endv in [None]:
+				eidx = min(sidx + count - 1, len(sdict) - 1)
+				endv = sdict[eidx]
+			else:
+				eidx = None
+				for idx in range(sidx, len(sdict)):
+					if sdict[idx] <= endv:
+						endv = sdict[idx]
+						eidx = idx
+						break
+				if eidx is None:
+					if DBG > 1: logger.debug("get_range no end key found")
+					return {}
+				count = eidx - sidx + 1
 		res = {}
 		for idx in range(sidx, eidx + 1):
 			res[sdict[idx]] = udict[sdict[idx]]
@@ -650,11 +897,17 @@ class DictBackedTable(Table):
 		csk.total_item_count = len(sdict)
 		csk.at_start = csk.start_key == sdict[0]
 		csk.at_end = csk.end_key == sdict[-1]
+		csk.set_cursors()
 
 		for r in res:
 			yield res[r]
 
 
+	def aggregate(self, query, aggs, group_by=None):
+		recs = [self.index[k].__dict__ for k in self.index]
+		return Aggregation(aggs, group_by).add_many([r for r in recs if query.match(r)]).rows()
+
+
 	def find(self, key, keyfield=None):
 		if keyfield is None or keyfield == self.keyfield:  # native key searc
 			try:
@@ -851,18 +1104,17 @@ class LogQ(Item):
 
 
 	async def prune_logitem_table(self, count):
+		""" with write_behind the delete is a future, the next prune waits for it """
 		logger.debug("starting prune of %s item", count)
-		csk = CSearchKey(
-			table_name=LogItem._table.tablename,
-			key_field="ts",
-			start_key=None,
-			start_item_number=0,
-			count=count)
-		for item in LogItem._table.get_range(csk):
-			logger.debug("pruning item %s", item)
-			item.delete()
-		logger.debug("prune done, table size %s", len(LogItem._table))
-		self.prune_in_progress = False
+		try:
+			deleted = LogItem._table.delete_oldest(count)
+			if asyncio.isfuture(deleted):
+				deleted = await deleted
+			logger.debug("prune done, %s deleted, table size %s", deleted, len(LogItem._table))
+		except Exception as e:
+			logger.error("%s: prune of %s items failed: %s", self, count, e)
+		finally:
+			self.prune_in_progress = False
 
 
 	async def start(self):
@@ -24,12 +24,16 @@ from . import DBG, DBGK
 from .const import PROJECT_PACKAGE_NAME, __version__, DEFAULT_CONFIG_FILE
 from .mqtt import Mqtt, Mqtt_Broker
 from .linkage import Attach as linkageAttach
+from .linkage import Table
 from .linkage import LogQ
 from .linkage import DictBackedTable
-from .steamlink import SteamSetup, Steam, set_steam_root
+from .steamlink import SteamSetup, Steam, set_steam_root, set_rollups
 from .steamlink import Attach as steamlinkAttach
 from .web import WebApp
 from .db import DB
+from .seglog import dir_compression_stats
+from .retention import Retention
+from .rollup import Rollups
 from .util import getargs, loadconfig, createconfig, daemonize, check_pid, write_pid
 from .testdata import TestData
 
@@ -135,8 +139,38 @@ DEFAULT_CONF = OrderedDict({
 		})
 	}),
 	'DB':          OrderedDict({
-		'db_filename': home + '/.steamlink/steamlink.db',
-	})
+		'backend':           'tinydb',  # or 'sqlite'
+		'db_filename':       home + '/.steamlink/steamlink.db',
+		'journal_max_bytes': 4 * 1024 * 1024,
+		'journal_fsync':     1.0,  # seconds, 0 syncs every change, -1 never
+		'table_dir':         None,  # e.g. home + '/.steamlink/tables', a file per table
+		'flush_interval':    0,  # seconds
+		'tables':            {},  # e.g. {'Node': {'flush_interval': 60, 'journal_fsync': 10, 'filename': ...}}
+		'lazy_tables':       ['Packet', 'LogItem'],
+		'sqlite_filename':   home + '/.steamlink/steamlink.sqlite',
+		'seglog_tables':     [],  # e.g. ['Packet', 'LogItem']
+		'seglog_dir':        home + '/.steamlink/seglog',
+		'segment_records':   10000,
+		'partition_seconds': 24 * 3600,
+		'max_partitions':    0,  # 0 keeps all
+		'compress_level':    0,  # zlib level for closed segments, 0 is off
+		'block_records':     256,
+		'index_max':         64,  # range indexes per table, not counting held ones
+		'index_max_keys':    1000000,  # keys in the range indexes of a table, not counting held ones
+		'write_behind':      False,
+		'write_queue_max':   10000,
+	}),
+	'retention':   OrderedDict({
+		'interval':    60,
+		'batch':       10000,  # records deleted per table and run
+		'archive_dir': home + '/.steamlink/archive',
+		# e.g. {'Packet': {'max_age': 30 * 24 * 3600, 'max_rows': 0, 'max_bytes': 0, 'archive': True}}
+		'tables':      {},
+	}),
+	'rollups':     OrderedDict({
+		'periods':        [60, 3600],  # seconds per bucket
+		'flush_interval': 5,
+	}),
 })
 
 
@@ -264,6 +298,14 @@ def steamlink_main(cl_args, conf):
 	steam = Steam(conf_steam)
 	set_steam_root(steam)
 
+	retention = Retention(conf['retention'], aioloop, db)
+	steam._retention = retention
+	coros.append(retention.start())
+
+	rollups = Rollups(conf['rollups'], aioloop)
+	set_rollups(rollups)
+	coros.append(rollups.start())
+
 	if cl_args.testdata:
 		testconfigs = conf['tests']
 		logger.debug("startup: create TestData")
@@ -299,6 +341,11 @@ def steamlink_main(cl_args, conf):
 
 	# Shutdown
 	webapp.stop()
+	retention.stop()
+	rollups.stop()
+	rollups.flush()
+	for table in Table.tables.values():
+		table.insert_pending()
 	aioloop.run_until_complete(db.stop())
 	if TestTask:
 		logger.debug("stopping TestTask")
@@ -319,6 +366,20 @@ def steamlink_main(cl_args, conf):
 daemon = False
 
 
+def seglog_stats(conf_db):
+	""" print the compression stats of the segment logs, they are keyed by time stamp """
+	for name in conf_db['seglog_tables']:
+		dirname = os.path.join(conf_db['seglog_dir'], name)
+		if not os.path.isdir(dirname):
+			print("%s: no segment log in %s" % (name, dirname))
+			continue
+		stats = dir_compression_stats(dirname, 'ts')
+		print("%s: %s segments, %s blocks, %s -> %s bytes, ratio %.2f, decode %.1f MB/s" % (
+			name, stats['segments'], stats['blocks'], stats['raw_bytes'], stats['stored_bytes'],
+			stats['ratio'], stats['decode_mb_s']))
+	return 0
+
+
 def steamlink_command():
 	global daemon, DBG, DBGK
 	cl_args = getargs()
@@ -372,6 +433,9 @@ def steamlink_command():
 	# load config
 	conf = loadconfig(DEFAULT_CONF, conff)
 
+	if cl_args.seglog_stats:
+		return seglog_stats(conf['DB'])
+
 	try:
 		restart = steamlink_main(cl_args, conf)
 		rc = 0
@@ -0,0 +1,239 @@
+# python library Steamlink
+
+import logging
+import operator
+
+from . import (DBG, DBGK)
+
+logger = logging.getLogger()
+
+
+def op_in(a, b):
+	return a in b
+
+
+# operators usable in queries and CSearch restrictions
+OPS = {
+	'==': operator.eq,
+	'!=': operator.ne,
+	'<':  operator.lt,
+	'<=': operator.le,
+	'>':  operator.gt,
+	'>=': operator.ge,
+	'in': op_in,
+}
+EQ_OPS = ['==', 'in']
+RANGE_OPS = ['<', '<=', '>', '>=']
+
+
+#
+# Pred
+#
+class Pred:
+	""" predicate 'field op value' """
+
+
+	def __init__(self, field, op, value):
+		if op not in OPS:
+			raise ValueError("unsupported op '%s'" % op)
+		self.field = field
+		self.op = op
+		self.value = value
+		self.opf = OPS[op]
+
+
+	def __repr__(self):
+		return "%s %s %r" % (self.field, self.op, self.value)
+
+
+	def values(self):
+		""" values an EQ_OPS predicate matches """
+		return self.value if self.op == 'in' else [self.value]
+
+
+	def match(self, rec):
+		if self.field not in rec:
+			return False
+		try:
+			return self.opf(rec[self.field], self.value)
+		except TypeError:  # e.g. None < 1
+			return False
+
+
+#
+# Query
+#
+class Query:
+	""" conjunction of predicates, the shape is the list of (field, op) """
+
+
+	def __init__(self, preds):
+		self.preds = preds
+		self.shape = tuple((p.field, p.op) for p in preds)
+
+
+	@classmethod
+	def where(cls, field, op, value):
+		return cls([Pred(field, op, value)])
+
+
+	@classmethod
+	def from_restrictions(cls, restrict_by):
+		""" query for CSearchKey restrictions, a list of {field_name, op, value} """
+		return cls([Pred(r['field_name'], r['op'], r['value']) for r in restrict_by])
+
+
+	def __repr__(self):
+		return " and ".join([repr(p) for p in self.preds])
+
+
+	def match(self, rec):
+		for pred in self.preds:
+			if not pred.match(rec):
+				return False
+		return True
+
+
+#
+# Plan
+#
+class Plan:
+	""" access method for a query shape, the predicate at pos selects the
+		candidates, all predicates are checked on them
+		methods: 'primary', 'secondary', 'sorted' or 'scan'
+	"""
+
+
+	def __init__(self, method, pos=None):
+		self.method = method
+		self.pos = pos
+
+
+	def __repr__(self):
+		return "Plan(%s %s)" % (self.method, self.pos)
+
+
+#
+# QueryPlanner
+#
+class QueryPlanner:
+	""" picks the cheapest index for a query, plans are cached by shape
+		- primary: '==' or 'in' on the key field
+		- secondary: '==' or 'in' on a field in secondary
+		- sorted: range op on a field that sorted_fields() returns, its index
+		  must hold every record, i.e. be on a unique field
+	"""
+	METHOD_COST = {'primary': 0, 'secondary': 1, 'sorted': 2}
+
+
+	def __init__(self, key_field, secondary=(), sorted_fields=None):
+		self.key_field = key_field
+		self.secondary = secondary
+		self.sorted_fields = sorted_fields
+		self.plans = {}
+
+
+	def plan(self, query):
+		sorted_fields = self.sorted_fields() if self.sorted_fields is not None else ()
+		cache_key = (query.shape, tuple([f in sorted_fields for f, op in query.shape]))
+		if cache_key in self.plans:
+			return self.plans[cache_key]
+
+		best = Plan('scan')
+		for pos, (field, op) in enumerate(query.shape):
+			if op in EQ_OPS and field == self.key_field:
+				method = 'primary'
+			elif op in EQ_OPS and field in self.secondary:
+				method = 'secondary'
+			elif op in RANGE_OPS and field in sorted_fields:
+				method = 'sorted'
+			else:
+				continue
+			if best.method == 'scan' or self.METHOD_COST[method] < self.METHOD_COST[best.method]:
+				best = Plan(method, pos)
+		if 'dbops' in DBGK: logger.debug("QueryPlanner %s: %s", query.shape, best)
+		self.plans[cache_key] = best
+		return best
+
+
+#
+# Aggregation
+#
+class Aggregation:
+	""" count, sum, min, max and mean over records, per value of the field
+		group_by if it is given
+		aggs is a list of (op, field), a count without field counts records,
+		other ops skip records where field is missing or None
+	"""
+	OPS = ['count', 'sum', 'min', 'max', 'mean']
+
+
+	def __init__(self, aggs, group_by=None):
+		self.aggs = []
+		for op, field in aggs:
+			if op not in self.OPS:
+				raise ValueError("unsupported aggregate '%s'" % op)
+			if field is None and op != 'count':
+				raise ValueError("aggregate '%s' needs a field" % op)
+			self.aggs.append((op, field))
+		self.group_by = group_by
+		self.groups = {}  # group value -> list of state per agg
+
+
+	@staticmethod
+	def name(op, field):
+		return op if field is None else "%s_%s" % (op, field)
+
+
+	def add(self, rec):
+		key = rec.get(self.group_by) if self.group_by is not None else None
+		states = self.groups.get(key)
+		if states is None:
+			states = self.groups[key] = [[0, None] if op == 'mean' else (0 if op == 'count' else None)
+										 for op, field in self.aggs]
+		for i, (op, field) in enumerate(self.aggs):
+			if field is None:
+				states[i] += 1
+				continue
+			val = rec.get(field)
+			if val is None:
+				continue
+			if op == 'count':
+				states[i] += 1
+			elif op == 'mean':
+				states[i][0] += 1
+				states[i][1] = val if states[i][1] is None else states[i][1] + val
+			elif states[i] is None:
+				states[i] = val
+			elif op == 'sum':
+				states[i] += val
+			elif op == 'min':
+				states[i] = min(states[i], val)
+			else:
+				states[i] = max(states[i], val)
+
+
+	def add_many(self, recs):
+		for rec in recs:
+			self.add(rec)
+		return self
+
+
+	def rows(self):
+		""" a dict per group, with the group_by value and a value per agg, by name() """
+		rows = []
+		for key, states in self.groups.items():
+			row = {} if self.group_by is None else {self.group_by: key}
+			for (op, field), state in zip(self.aggs, states):
+				if op == 'mean':
+					state = state[1] / state[0] if state[0] > 0 else None
+				row[self.name(op, field)] = state
+			rows.append(row)
+		if self.group_by is None and len(rows) == 0:
+			rows.append({self.name(op, field): 0 if op == 'count' else None for op, field in self.aggs})
+		if self.group_by is not None:
+			try:
+				rows.sort(key=lambda row: row[self.group_by])
+			except TypeError:  # group values of mixed types, e.g. None
+				pass
+		return rows
@@ -0,0 +1,152 @@
+# python library Steamlink
+
+import asyncio
+import logging
+import os
+import time
+
+from . import (DBG, DBGK)
+from .archive import ColumnArchive
+from .linkage import Table
+
+logger = logging.getLogger()
+
+
+#
+# Retention
+#
+class Retention:
+	""" background task that keeps tables within their limits
+		conf 'tables' maps a table name to limits:
+		- max_age: seconds, for tables keyed by time stamp
+		- max_rows: number of records
+		- max_bytes: estimated size of the records
+		- archive: move expired records to a ColumnArchive in conf 'archive_dir',
+		  for tables whose items define archive_columns, e.g. Packet; the
+		  archive is set as the table's archive, cursor pages read it
+		records over a limit are deleted oldest first, in bulk through the
+		storage layer, every conf 'interval' seconds, at most conf 'batch' per
+		table and run, so that a backlog is worked off over several runs; with
+		write_behind the deletes are applied by the DBWriter, a run awaits them,
+		and first awaits the queued writes, so that positions count them
+	"""
+
+
+	def __init__(self, conf, loop=None, db=None):
+		self.name = "Retention"
+		self.conf = conf
+		self.loop = loop
+		self.db = db
+		self.interval = conf.get('interval', 60)
+		self.batch = conf.get('batch', 10000)
+		self.running = True
+		self.reclaimed = {}  # table name -> {'rows', 'bytes', 'runs'}
+		self.archives = {}  # table name -> ColumnArchive
+
+
+	def stop(self):
+		self.running = False
+
+
+	async def start(self):
+		logger.info("%s starting, every %ss for %s", self.name, self.interval, list(self.conf.get('tables', {})))
+		tables = self.conf.get('tables', {})
+		for name in tables:
+			table = Table.tables.get(name)
+			if tables[name].get('archive', False) and table is not None and hasattr(table, 'delete_oldest'):
+				self.archive(name, table)
+		while self.running:
+			await asyncio.sleep(self.interval)
+			try:
+				await self.run()
+			except Exception as e:
+				logger.error("%s: run failed: %s", self.name, e)
+
+
+	async def run(self):
+		tables = self.conf.get('tables', {})
+		for name in tables:
+			table = Table.tables.get(name)
+			if table is None or not hasattr(table, 'delete_oldest'):
+				continue
+			await self.apply(name, table, tables[name])
+
+
+	def archive(self, name, table):
+		""" the ColumnArchive for table name, None if its items define no archive_columns """
+		if name not in self.archives:
+			itemclass = table.itemclass
+			if getattr(itemclass, 'archive_columns', None) is None:
+				logger.error("%s: %s has no archive columns", self.name, name)
+				self.archives[name] = None
+			else:
+				self.archives[name] = ColumnArchive(os.path.join(self.conf['archive_dir'], name),
+													itemclass.archive_columns,
+													getattr(itemclass, 'archive_side', ()),
+													getattr(itemclass, 'archive_encode', None),
+													getattr(itemclass, 'archive_decode', None))
+				table.archive = self.archives[name]
+		return self.archives[name]
+
+
+	async def expire(self, name, table, limits, key, inclusive=False):
+		""" archive, if configured, and delete the records with keys < key (<= key if inclusive),
+			at most batch of them
+		"""
+		if self.batch > 0:
+			last = table.dbtable.key_at(self.batch - 1)
+			if last is not None and last < key:
+				key, inclusive = last, True
+		if limits.get('archive', False) and self.archive(name, table) is not None:
+			op = '<=' if inclusive else '<'
+			recs = table.dbtable.search(table.keyfield, op, key)
+			self.archives[name].append_many(recs)
+		count = table.delete_before(key, inclusive)
+		if asyncio.isfuture(count):  # queued for the DBWriter
+			count = await count
+		return count
+
+
+	async def apply(self, name, table, limits):
+		""" delete the records of table over limits, return (rows, bytes) reclaimed """
+		if self.db is not None:
+			await self.db.caught_up()  # write_behind: key_at sees the applied records
+		rows_before = len(table)
+		bytes_before = table.dbtable.size_bytes()
+		if rows_before == 0:
+			return 0, 0
+
+		rows = 0
+		max_age = limits.get('max_age', 0)
+		if max_age > 0:
+			rows += await self.expire(name, table, limits, time.time() - max_age)
+
+		excess = len(table) - limits.get('max_rows', 0)
+		if self.batch > 0:
+			excess = min(excess, self.batch)
+		if limits.get('max_rows', 0) > 0 and excess > 0:
+			rows += await self.expire(name, table, limits, table.dbtable.key_at(excess - 1), inclusive=True)
+
+		max_bytes = limits.get('max_bytes', 0)
+		size = table.dbtable.size_bytes()
+		if max_bytes > 0 and size > max_bytes and len(table) > 0:
+			rec_bytes = size / len(table)
+			excess = min(len(table), int((size - max_bytes) / rec_bytes) + 1)
+			if self.batch > 0:
+				excess = min(excess, self.batch)
+			rows += await self.expire(name, table, limits, table.dbtable.key_at(excess - 1), inclusive=True)
+
+		if rows == 0:
+			return 0, 0
+		reclaimed_bytes = max(0, bytes_before - table.dbtable.size_bytes())
+		stats = self.reclaimed.setdefault(name, {'rows': 0, 'bytes': 0, 'runs': 0})
+		stats['rows'] += rows
+		stats['bytes'] += reclaimed_bytes
+		stats['runs'] += 1
+		logger.debug("%s: %s reclaimed %s records, %s bytes, %s left", self.name, name, rows, reclaimed_bytes,
+					 len(table))
+		return rows, reclaimed_bytes
+
+
+	def status(self):
+		return self.reclaimed
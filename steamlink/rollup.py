@@ -0,0 +1,154 @@
+# python library Steamlink
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from . import (DBG, DBGK)
+from .linkage import Item
+
+logger = logging.getLogger()
+
+
+#
+# Rollup
+#
+class Rollup(Item):
+	""" packet counts and rssi of one node over one time bucket of period
+		seconds starting at ts, kept in the Rollup table
+		rid sorts in time order, so Retention's max_rows drops the oldest
+	"""
+	keyfield = 'rid'
+
+
+	def __init__(self, slid=None, period=None, ts=None):
+		self.slid = slid
+		self.period = period
+		self.ts = ts
+		self.packets = 0
+		self.duplicates = 0
+		self.missed = 0
+		self.rssi_min = None
+		self.rssi_max = None
+		self.rssi_sum = 0
+		self.rid = None if slid is None else self.make_rid(slid, period, ts)
+		super().__init__(self.rid)
+
+
+	@staticmethod
+	def make_rid(slid, period, ts):
+		return "%010d-%d-%d" % (ts, period, slid)
+
+
+	def add(self, rssi=None, packets=0, duplicates=0, missed=0):
+		self.packets += packets
+		self.duplicates += duplicates
+		self.missed += missed
+		if rssi is not None:
+			self.rssi_min = rssi if self.rssi_min is None else min(self.rssi_min, rssi)
+			self.rssi_max = rssi if self.rssi_max is None else max(self.rssi_max, rssi)
+			self.rssi_sum += rssi
+
+
+	def save(self, withvirtual=False):
+		r = {
+			'rid':        self.rid,
+			'slid':       self.slid,
+			'period':     self.period,
+			'ts':         self.ts,
+			'packets':    self.packets,
+			'duplicates': self.duplicates,
+			'missed':     self.missed,
+			'rssi_min':   self.rssi_min,
+			'rssi_max':   self.rssi_max,
+			'rssi_sum':   self.rssi_sum,
+		}
+		if withvirtual:
+			r['Time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.ts))
+			r['rssi_avg'] = self.rssi_sum / self.packets if self.packets > 0 else None
+			r['packets_per_min'] = self.packets * 60 / self.period
+		return r
+
+
+#
+# Rollups
+#
+class Rollups:
+	""" per node aggregates of packets, in time buckets of each of conf
+		'periods' seconds, e.g. per minute and per hour
+		- add() updates the current bucket of the node in memory, O(1)
+		- changed buckets are written to the Rollup table every conf
+		  'flush_interval' seconds, in one update_many, which also updates
+		  the CSearches on the table
+		- a packet for an older bucket, e.g. after a restart, updates that
+		  bucket, read back from the table
+	"""
+
+
+	def __init__(self, conf, loop=None):
+		self.name = "Rollups"
+		self.conf = conf
+		self.loop = loop
+		self.periods = conf.get('periods', [60, 3600])
+		self.interval = conf.get('flush_interval', 5)
+		self.running = True
+		self.current = {}  # (slid, period) -> Rollup of the newest bucket
+		self.dirty = OrderedDict()  # rid -> Rollup, changed since the last flush
+		self.flushes = 0
+
+
+	def stop(self):
+		self.running = False
+
+
+	async def start(self):
+		logger.info("%s starting, %s second buckets, flush every %ss", self.name, self.periods, self.interval)
+		while self.running:
+			await asyncio.sleep(self.interval)
+			try:
+				self.flush()
+			except Exception as e:
+				logger.error("%s: flush failed: %s", self.name, e)
+
+
+	def bucket(self, slid, period, ts):
+		""" the Rollup for slid of the bucket of period seconds that ts is in """
+		start = int(ts // period * period)
+		cur = self.current.get((slid, period))
+		if cur is not None and cur.ts == start:
+			return cur
+		rid = Rollup.make_rid(slid, period, start)
+		rollup = self.dirty.get(rid)
+		if rollup is None:
+			rollup = Rollup._table.find_one(rid)
+		if rollup is None:
+			rollup = Rollup(slid, period, start)
+		if cur is None or start > cur.ts:
+			self.current[(slid, period)] = rollup
+		return rollup
+
+
+	def add(self, slid, ts, rssi=None, packets=0, duplicates=0, missed=0):
+		""" count packets, duplicates and missed packets of node slid at time ts """
+		for period in self.periods:
+			rollup = self.bucket(slid, period, ts)
+			rollup.add(rssi, packets, duplicates, missed)
+			self.dirty[rollup.rid] = rollup
+		if 'rollup' in DBGK: logger.debug("%s add %s %s: %s dirty", self.name, slid, ts, len(self.dirty))
+
+
+	def flush(self):
+		""" write the changed buckets to the Rollup table """
+		if len(self.dirty) == 0:
+			return
+		rollups = list(self.dirty.values())
+		self.dirty = OrderedDict()
+		Rollup._table.update_many(rollups)
+		self.flushes += 1
+		if 'rollup' in DBGK: logger.debug("%s flushed %s buckets", self.name, len(rollups))
+
+
+	def status(self):
+		return {'nodes': len(set(slid for slid, period in self.current)), 'dirty': len(self.dirty),
+				'flushes': self.flushes}
@@ -0,0 +1,927 @@
+# python library Steamlink
+
+import bisect
+import heapq
+import json
+import logging
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+from . import (DBG, DBGK)
+from .dbindex import DBIndexFarm, DBFieldIndex
+from .query import Query, QueryPlanner, Aggregation
+
+logger = logging.getLogger()
+
+SEG_CACHE_SIZE = 8  # closed segments kept decoded in memory
+
+
+def compression_stats(segments, decode=False):
+	""" size and decode throughput of the compressed segments
+		decode reads all their blocks first, to measure the throughput
+	"""
+	segs = [seg for seg in segments if seg.blocks is not None]
+	if decode:
+		for seg in segs:
+			seg.read()
+	raw = sum(seg.raw_bytes for seg in segs)
+	stored = sum(seg.file_size() for seg in segs)
+	decoded = sum(seg.decoded_bytes for seg in segs)
+	seconds = sum(seg.decode_seconds for seg in segs)
+	return {
+		'segments':     len(segs),
+		'blocks':       sum(len(seg.blocks) for seg in segs),
+		'raw_bytes':    raw,
+		'stored_bytes': stored,
+		'ratio':        raw / stored if stored > 0 else 0.0,
+		'decode_mb_s':  decoded / seconds / 1e6 if seconds > 0 else 0.0,
+	}
+
+
+def dir_compression_stats(dirname, key_field):
+	""" compression_stats of the closed segments of a SegLogTable in dirname,
+		decoding all blocks, without opening the table
+	"""
+	segs = []
+	for f in sorted(os.listdir(dirname)):
+		if f.endswith('.idx'):
+			seg = Segment(os.path.join(dirname, f[:-4]), int(f[:-4]), key_field)
+			if seg.load_idx():
+				segs.append(seg)
+	return compression_stats(segs, decode=True)
+
+
+#
+# Segment
+#
+class Segment:
+	""" one file of a SegLogTable, records are appended as json lines
+		a closed segment has an .idx file with its key range and record count,
+		so opening it does not require reading the records
+		a compressed segment is a .segz file of zlib blocks of block_records
+		records in key order, its .idx has the key range, offset and length of
+		each block, so a key range only decodes the blocks that overlap it
+	"""
+
+
+	def __init__(self, path, seqno, key_field):
+		self.path = path  # without extension
+		self.seqno = seqno
+		self.key_field = key_field
+		self.min_key = None
+		self.max_key = None
+		self.count = 0  # records written, including deleted ones
+		self.closed = False
+		self.fd = None
+		self.blocks = None  # block index of a compressed segment
+		self.raw_bytes = 0  # size before compression
+		self.decoded_bytes = 0
+		self.decode_seconds = 0.0
+
+
+	def __str__(self):
+		return "Segment(%s %s..%s #%s%s)" % (self.seqno, self.min_key, self.max_key, self.count,
+											 " closed" if self.closed else "")
+
+
+	def load_idx(self):
+		try:
+			with open(self.path + '.idx') as f:
+				idx = json.load(f)
+		except (OSError, ValueError):
+			return False
+		self.min_key = idx['min_key']
+		self.max_key = idx['max_key']
+		self.count = idx['count']
+		self.blocks = idx.get('blocks')
+		self.raw_bytes = idx.get('raw_bytes', 0)
+		self.closed = True
+		return True
+
+
+	def write_idx(self):
+		idx = {'min_key': self.min_key, 'max_key': self.max_key, 'count': self.count}
+		if self.blocks is not None:
+			idx['blocks'] = self.blocks
+			idx['raw_bytes'] = self.raw_bytes
+		with open(self.path + '.idx.tmp', 'w') as f:
+			json.dump(idx, f)
+		os.replace(self.path + '.idx.tmp', self.path + '.idx')
+
+
+	def read(self, deleted=()):
+		""" return the live records as a key sorted list of (key, lineno, rec) """
+		if self.blocks is not None:
+			recs = []
+			for i in range(len(self.blocks)):
+				recs.extend(self.read_block(i, deleted))
+			return recs
+		recs = []
+		with open(self.path + '.seg') as f:
+			for lineno, line in enumerate(f):
+				if lineno in deleted:
+					continue
+				try:
+					rec = json.loads(line)
+				except ValueError:
+					logger.warning("%s: skipping bad record %s", self, lineno)
+					continue
+				recs.append((rec[self.key_field], lineno, rec))
+		recs.sort(key=lambda r: (r[0], r[1]))
+		return recs
+
+
+	def read_block(self, i, deleted=()):
+		""" return the live records of block i as a key sorted list of (key, lineno, rec) """
+		block = self.blocks[i]
+		t = time.time()
+		with open(self.path + '.segz', 'rb') as f:
+			f.seek(block['offset'])
+			data = zlib.decompress(f.read(block['length']))
+		recs = [(rec[self.key_field], lineno, rec) for lineno, rec in json.loads(data.decode('utf-8'))
+				if lineno not in deleted]
+		self.decoded_bytes += len(data)
+		self.decode_seconds += time.time() - t
+		return recs
+
+
+	def compress(self, level, block_records):
+		""" rewrite a closed segment as zlib blocks of block_records records """
+		self.compressed(*self.encode(level, block_records))
+
+
+	def encode(self, level, block_records):
+		""" write the .segz file of a closed segment, return (block index, raw bytes)
+			the segment is not changed, and reads its .seg file, until compressed()
+			is called, so this can run in another thread
+		"""
+		recs = self.read()
+		raw_bytes = os.path.getsize(self.path + '.seg')
+		blocks = []
+		with open(self.path + '.segz.tmp', 'wb') as f:
+			for i in range(0, len(recs), block_records):
+				chunk = recs[i:i + block_records]
+				data = json.dumps([[lineno, rec] for key, lineno, rec in chunk], separators=(',', ':'))
+				data = zlib.compress(data.encode('utf-8'), level)
+				blocks.append({'min_key': chunk[0][0], 'max_key': chunk[-1][0], 'offset': f.tell(),
+							   'length': len(data), 'count': len(chunk)})
+				f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(self.path + '.segz.tmp', self.path + '.segz')
+		return blocks, raw_bytes
+
+
+	def compressed(self, blocks, raw_bytes):
+		""" switch to the .segz file written by encode() """
+		self.blocks = blocks
+		self.raw_bytes = raw_bytes
+		self.write_idx()
+		os.unlink(self.path + '.seg')
+
+
+	def rank(self, key, right=False):
+		""" number of records with keys < key (<= key if right) in a compressed
+			segment without deleted records, decoding only the block key falls in
+		"""
+		n = 0
+		for i, block in enumerate(self.blocks):
+			if block['max_key'] < key or (right and block['max_key'] == key):
+				n += block['count']
+			elif block['min_key'] < key or (right and block['min_key'] == key):
+				recs = self.read_block(i)
+				if right:
+					n += bisect.bisect_right(recs, (key, float('inf')))
+				else:
+					n += bisect.bisect_left(recs, (key,))
+			else:
+				break
+		return n
+
+
+	def slice(self, start, stop):
+		""" records at positions start..stop-1, decoding only the blocks needed """
+		pos = 0
+		for i, block in enumerate(self.blocks):
+			if pos + block['count'] > start:
+				for key, lineno, rec in self.read_block(i)[max(0, start - pos):stop - pos]:
+					yield rec
+			pos += block['count']
+			if pos >= stop:
+				break
+
+
+	def file_size(self):
+		return os.path.getsize(self.path + ('.segz' if self.blocks is not None else '.seg'))
+
+
+	def scan(self):
+		""" set key range and count from the segment file, for segments without index """
+		self.count = 0
+		self.min_key = self.max_key = None
+		with open(self.path + '.seg', 'rb') as f:
+			data = f.read()
+		if len(data) > 0 and not data.endswith(b'\n'):  # torn write at crash, drop partial record
+			logger.warning("%s: truncating partial record", self)
+			with open(self.path + '.seg', 'r+b') as f:
+				f.truncate(data.rfind(b'\n') + 1)
+		for key, lineno, rec in self.read():
+			self.add_key(key)
+		self.count = data.count(b'\n')
+
+
+	def add_key(self, key):
+		if self.min_key is None or key < self.min_key:
+			self.min_key = key
+		if self.max_key is None or key > self.max_key:
+			self.max_key = key
+
+
+	def has_key_range(self, lo, hi):
+		""" true if records with keys in lo..hi can be in this segment """
+		if self.min_key is None:
+			return False
+		return (hi is None or self.min_key <= hi) and (lo is None or self.max_key >= lo)
+
+
+	def append(self, rec):
+		if self.fd is None:
+			self.fd = open(self.path + '.seg', 'a')
+		self.fd.write(json.dumps(rec, separators=(',', ':')) + '\n')
+		lineno = self.count
+		self.count += 1
+		self.add_key(rec[self.key_field])
+		return lineno
+
+
+	def flush(self):
+		if self.fd is not None:
+			self.fd.flush()
+
+
+	def close(self):
+		if self.fd is not None:
+			self.fd.close()
+			self.fd = None
+
+
+	def unlink(self):
+		self.close()
+		for ext in ['.seg', '.segz', '.idx']:
+			try:
+				os.unlink(self.path + ext)
+			except FileNotFoundError:
+				pass
+
+
+#
+# SegLogTable
+#
+class SegLogTable:
+	""" append-only DBTable for immutable records, e.g. Packet and LogItem
+		- records are appended to fixed size segment files in dirname,
+		  a full segment is closed and gets a key range index
+		- deletes write a tombstone (seqno, lineno) to 'deleted', segments
+		  without live records are removed
+		- updates are merged into the record and written as (seqno, lineno,
+		  record) to 'updated', the record stays in its segment
+		- keys are unique, records are ordered by key within a segment;
+		  segments are in key order as long as keys grow, as time stamps do,
+		  a late key, e.g. a packet stored when its ack arrives, goes to the
+		  active segment, and ranges merge the segments it overlaps, see runs()
+		- the DBFieldIndex for a field in indexes, and the DBCompositeIndex
+		  for a (field, key_field) tuple, are built by a scan on first use,
+		  not on open
+		- with partition_seconds, a time stamp key starting a new partition,
+		  e.g. a new day, starts a new segment; only the max_partitions
+		  newest partitions are kept, older ones are dropped by unlinking
+		  their segments
+		- with compress_level, closed segments are compressed in blocks of
+		  block_records records; ranges over compressed segments that are
+		  not decoded in the cache only decode the blocks they overlap
+		- with an executor, segments are compressed in it, a segment switches
+		  to its compressed file on the next flush or segment close after that
+	"""
+
+
+	def __init__(self, dirname, name, key_field, segment_records=10000, indexes=(),
+				 partition_seconds=0, max_partitions=0, compress_level=0, block_records=256, executor=None):
+		if DBG > 2: logger.debug("SegLogTable %s", name)
+		self.dirname = dirname
+		self.name = name
+		self.key_field = key_field
+		self.segment_records = segment_records
+		self.partition_seconds = partition_seconds
+		self.max_partitions = max_partitions  # 0 keeps all
+		self.compress_level = compress_level  # zlib level, 0 does not compress
+		self.block_records = block_records
+		self.executor = executor
+		self.compressing = OrderedDict()  # seqno -> (segment, future of Segment.encode)
+		self.segments = []  # in seqno order, last one is active
+		self.deleted = {}  # seqno -> set of deleted linenos
+		self.updated = {}  # seqno -> {lineno: record}
+		self.max_key = None  # largest key appended, a larger key is not a duplicate
+		self.seg_cache = OrderedDict()  # seqno -> decoded records, LRU
+		self.live_count = 0
+		self.restrict_idxs = DBIndexFarm(self, key_field, self.record, [f for f in indexes if not isinstance(f, str)])
+		self.index_fields = [f for f in indexes if isinstance(f, str)]
+		self.field_idxs = {}  # built on demand
+		self.planner = QueryPlanner(key_field, self.index_fields, lambda: [key_field])
+		self.deleted_fd = None
+		self.updated_fd = None
+		self.open()
+
+
+	def seg_path(self, seqno):
+		return os.path.join(self.dirname, "%08d" % seqno)
+
+
+	def open(self):
+		os.makedirs(self.dirname, exist_ok=True)
+		seqnos = sorted(set(int(f.split('.')[0]) for f in os.listdir(self.dirname)
+							if f.endswith('.seg') or f.endswith('.segz')))
+		for seqno in seqnos:
+			seg = Segment(self.seg_path(seqno), seqno, self.key_field)
+			if seg.load_idx() and seg.blocks is not None:
+				if os.path.exists(seg.path + '.seg'):  # crashed after compressing
+					os.unlink(seg.path + '.seg')
+			elif os.path.exists(seg.path + '.segz'):
+				if not os.path.exists(seg.path + '.seg'):
+					logger.error("SegLogTable %s: %s has no block index, skipped", self.name, seg)
+					continue
+				os.unlink(seg.path + '.segz')  # crashed before the index was written
+			if not seg.closed:
+				seg.scan()
+				if seqno != seqnos[-1]:  # closed, but index was lost
+					seg.closed = True
+					seg.write_idx()
+			self.segments.append(seg)
+			if seg.closed and seg.blocks is None and self.compress_level > 0:
+				self.compress(seg)
+
+		self.load_deleted()
+		self.load_updated()
+		for seg in self.segments:
+			self.live_count += seg.count - len(self.deleted.get(seg.seqno, ()))
+			if seg.max_key is not None and (self.max_key is None or seg.max_key > self.max_key):
+				self.max_key = seg.max_key
+		if len(self.segments) == 0 or self.segments[-1].closed:
+			self.new_segment()
+		else:
+			self.seg_recs(self.segments[-1])  # the active segment stays decoded
+		logger.info("SegLogTable %s: %s segments, %s records", self.name, len(self.segments), self.live_count)
+
+
+	def load_deleted(self):
+		try:
+			with open(os.path.join(self.dirname, 'deleted')) as f:
+				for line in f:
+					try:
+						seqno, lineno = [int(v) for v in line.split()]
+					except ValueError:
+						continue
+					self.deleted.setdefault(seqno, set()).add(lineno)
+		except FileNotFoundError:
+			pass
+
+
+	def load_updated(self):
+		try:
+			with open(os.path.join(self.dirname, 'updated')) as f:
+				for line in f:
+					try:
+						seqno, lineno, rec = line.split(' ', 2)
+						self.updated.setdefault(int(seqno), {})[int(lineno)] = json.loads(rec)
+					except ValueError:  # torn write at crash
+						continue
+		except FileNotFoundError:
+			pass
+
+
+	def write_updated(self):
+		""" rewrite the update file, dropping updates of removed segments """
+		if self.updated_fd is not None:
+			self.updated_fd.close()
+			self.updated_fd = None
+		fname = os.path.join(self.dirname, 'updated')
+		with open(fname + '.tmp', 'w') as f:
+			for seqno in self.updated:
+				for lineno, rec in self.updated[seqno].items():
+					f.write("%s %s %s\n" % (seqno, lineno, json.dumps(rec, separators=(',', ':'))))
+		os.replace(fname + '.tmp', fname)
+
+
+	def write_deleted(self):
+		""" rewrite the tombstone file, dropping tombstones of removed segments """
+		if self.deleted_fd is not None:
+			self.deleted_fd.close()
+			self.deleted_fd = None
+		fname = os.path.join(self.dirname, 'deleted')
+		with open(fname + '.tmp', 'w') as f:
+			for seqno in self.deleted:
+				for lineno in self.deleted[seqno]:
+					f.write("%s %s\n" % (seqno, lineno))
+		os.replace(fname + '.tmp', fname)
+
+
+	def new_segment(self):
+		seqno = self.segments[-1].seqno + 1 if len(self.segments) > 0 else 0
+		seg = Segment(self.seg_path(seqno), seqno, self.key_field)
+		open(seg.path + '.seg', 'a').close()
+		self.segments.append(seg)
+		self.seg_cache[seqno] = []
+		if 'dbops' in DBGK: logger.debug("SegLogTable %s new %s", self.name, seg)
+		return seg
+
+
+	def close_segment(self, seg):
+		seg.close()
+		seg.closed = True
+		seg.write_idx()
+		if 'dbops' in DBGK: logger.debug("SegLogTable %s closed %s", self.name, seg)
+		self.compressed()
+		if self.compress_level > 0:
+			self.compress(seg)
+
+
+	def compress(self, seg):
+		""" compress a closed segment, in the executor if there is one """
+		if self.executor is None:
+			seg.compress(self.compress_level, self.block_records)
+			if 'dbops' in DBGK: logger.debug("SegLogTable %s compressed %s: %s", self.name, seg, self.compression_stats())
+			return
+		future = self.executor.submit(seg.encode, self.compress_level, self.block_records)
+		self.compressing[seg.seqno] = (seg, future)
+
+
+	def compressed(self, wait=False):
+		""" switch the segments whose compression finished to their compressed files """
+		for seqno in list(self.compressing):
+			seg, future = self.compressing[seqno]
+			if not future.done() and not wait:
+				continue
+			del self.compressing[seqno]
+			if seg not in self.segments:  # dropped meanwhile
+				future.exception()
+				try:
+					os.unlink(seg.path + '.segz')
+				except FileNotFoundError:
+					pass
+				continue
+			try:
+				blocks, raw_bytes = future.result()
+			except Exception as e:
+				logger.error("SegLogTable %s: compressing %s failed: %s", self.name, seg, e)
+				continue
+			seg.compressed(blocks, raw_bytes)
+			if 'dbops' in DBGK: logger.debug("SegLogTable %s compressed %s: %s", self.name, seg, self.compression_stats())
+
+
+	def seg_recs(self, seg):
+		""" return the live, key sorted (key, lineno, rec) list of a segment """
+		if seg.seqno in self.seg_cache:
+			self.seg_cache.move_to_end(seg.seqno)
+			return self.seg_cache[seg.seqno]
+		recs = seg.read(self.deleted.get(seg.seqno, ()))
+		updated = self.updated.get(seg.seqno)
+		if updated is not None:
+			recs = [(key, lineno, updated.get(lineno, rec)) for key, lineno, rec in recs]
+		self.seg_cache[seg.seqno] = recs
+		active = self.segments[-1].seqno
+		while len(self.seg_cache) > SEG_CACHE_SIZE:
+			seqno = next(s for s in self.seg_cache if s != active)
+			del self.seg_cache[seqno]
+		return recs
+
+
+	def block_wise(self, seg):
+		""" true if a range in seg is read by blocks instead of decoding all of it """
+		return seg.blocks is not None and seg.seqno not in self.seg_cache and seg.seqno not in self.deleted \
+			and seg.seqno not in self.updated
+
+
+	def seg_live(self, seg):
+		return seg.count - len(self.deleted.get(seg.seqno, ()))
+
+
+	def locate(self, key):
+		""" return (segment, position in seg_recs) of the record with key, or (None, None) """
+		for seg in reversed(self.segments):
+			if not seg.has_key_range(key, key):
+				continue
+			recs = self.seg_recs(seg)
+			i = bisect.bisect_left(recs, (key,))
+			if i < len(recs) and recs[i][0] == key:
+				return seg, i
+		return None, None
+
+
+	def record(self, key):
+		seg, i = self.locate(key)
+		return self.seg_recs(seg)[i][2]
+
+
+	def partition(self, key):
+		if self.partition_seconds == 0 or not isinstance(key, (int, float)):
+			return 0
+		return int(key // self.partition_seconds)
+
+
+	def runs(self):
+		""" the segments in groups with disjoint key ranges, in key order
+			a group has more than one segment only after a late key
+		"""
+		runs = []
+		hi = None
+		for seg in sorted((seg for seg in self.segments if seg.min_key is not None), key=lambda seg: seg.min_key):
+			if len(runs) > 0 and seg.min_key <= hi:
+				runs[-1].append(seg)
+				hi = max(hi, seg.max_key)
+			else:
+				runs.append([seg])
+				hi = seg.max_key
+		return runs
+
+
+	def exists(self, key):
+		return self.max_key is not None and key <= self.max_key and self.locate(key)[0] is not None
+
+
+	def append(self, rec):
+		""" append a new record to the active segment, false if its key exists """
+		key = rec[self.key_field]
+		if self.exists(key):
+			logger.error("duplicate record %s, rec %s, %s", self.name, key, rec)
+			return False
+		seg = self.segments[-1]
+		new_partition = seg.count > 0 and self.partition(key) > self.partition(seg.max_key)
+		if seg.count >= self.segment_records or new_partition:
+			self.close_segment(seg)
+			seg = self.new_segment()
+		if new_partition and self.max_partitions > 0:
+			self.drop_before((self.partition(key) - self.max_partitions + 1) * self.partition_seconds)
+		recs = self.seg_recs(seg)
+		lineno = seg.append(rec)
+		bisect.insort(recs, (rec[self.key_field], lineno, rec))
+		self.live_count += 1
+		if self.max_key is None or key > self.max_key:
+			self.max_key = key
+		for field in self.field_idxs:
+			self.field_idxs[field].db_insert(rec)
+		return True
+
+
+	def update(self, seg, i, rec):
+		""" merge rec into record i of seg, in place, return the updated record """
+		recs = self.seg_recs(seg)
+		key, lineno, old = recs[i]
+		new = dict(old)
+		new.update(rec)
+		recs[i] = (key, lineno, new)
+		self.updated.setdefault(seg.seqno, {})[lineno] = new
+		for field in self.field_idxs:
+			self.field_idxs[field].db_delete(old)
+			self.field_idxs[field].db_insert(new)
+		if self.updated_fd is None:
+			self.updated_fd = open(os.path.join(self.dirname, 'updated'), 'a')
+		self.updated_fd.write("%s %s %s\n" % (seg.seqno, lineno, json.dumps(new, separators=(',', ':'))))
+		return new
+
+
+	def remove(self, seg, i):
+		""" write a tombstone for record i of seg, drop seg if it has no live records """
+		recs = self.seg_recs(seg)
+		key, lineno, rec = recs.pop(i)
+		self.deleted.setdefault(seg.seqno, set()).add(lineno)
+		if lineno in self.updated.get(seg.seqno, {}):
+			del self.updated[seg.seqno][lineno]
+		for field in self.field_idxs:
+			self.field_idxs[field].db_delete(rec)
+		self.live_count -= 1
+		if self.seg_live(seg) == 0 and seg.closed:
+			self.drop_segment(seg)
+		else:
+			if self.deleted_fd is None:
+				self.deleted_fd = open(os.path.join(self.dirname, 'deleted'), 'a')
+			self.deleted_fd.write("%s %s\n" % (seg.seqno, lineno))
+		return rec
+
+
+	def drop_segment(self, seg):
+		""" remove a closed segment and its tombstones """
+		if 'dbops' in DBGK: logger.debug("SegLogTable %s dropping %s", self.name, seg)
+		self.live_count -= self.seg_live(seg)
+		seg.unlink()
+		self.segments.remove(seg)
+		self.seg_cache.pop(seg.seqno, None)
+		self.deleted.pop(seg.seqno, None)
+		self.write_deleted()
+		if self.updated.pop(seg.seqno, None) is not None:
+			self.write_updated()
+
+
+	def drop_before(self, key):
+		""" drop the closed segments with only keys < key, without reading them
+			unless indexes need their records, return the number of records dropped
+		"""
+		dropped = 0
+		for seg in list(self.segments[:-1]):
+			if seg.max_key is None or seg.max_key >= key:
+				continue
+			if self.restrict_idxs.in_use() or len(self.field_idxs) > 0:
+				for k, lineno, rec in self.seg_recs(seg):
+					self.restrict_idxs.db_delete(rec)
+					for field in self.field_idxs:
+						self.field_idxs[field].db_delete(rec)
+			dropped += self.seg_live(seg)
+			self.drop_segment(seg)
+		if dropped > 0:
+			logger.info("SegLogTable %s: dropped %s records before %s", self.name, dropped, key)
+		return dropped
+
+
+	def key_at(self, pos):
+		""" the key at position pos in key order, None if pos is past the end """
+		for rec in self.slice(pos, pos + 1):
+			return rec[self.key_field]
+		return None
+
+
+	def delete_before(self, key, inclusive=False):
+		""" delete the records with keys < key (<= key if inclusive), return their number
+			whole segments are dropped, the rest get tombstones
+		"""
+		deleted = self.drop_before(key)
+		recs = []
+		for seg in list(self.segments):
+			if not seg.has_key_range(None, key):
+				continue
+			seg_recs = self.seg_recs(seg)
+			if inclusive:
+				n = bisect.bisect_right(seg_recs, (key, float('inf')))
+			else:
+				n = bisect.bisect_left(seg_recs, (key,))
+			for i in range(n - 1, -1, -1):
+				recs.append(self.remove(seg, i))
+		self.restrict_idxs.delete_many(recs)
+		if 'dbops' in DBGK: logger.debug("delete_before %s %s: %s recs", self.name, key, deleted + len(recs))
+		return deleted + len(recs)
+
+
+	def size_bytes(self):
+		""" size of the live records in the segment files """
+		size = 0
+		for seg in self.segments:
+			if seg.count > 0:
+				size += seg.file_size() * self.seg_live(seg) // seg.count
+		return size
+
+
+	def compression_stats(self):
+		return compression_stats(self.segments)
+
+
+	def db_insert(self, rec):
+		assert self.key_field in rec, "record has not key_field"
+		if not self.append(rec):
+			return
+		if 'dbops' in DBGK: logger.debug("insert %s rec %s", self.name, rec)
+		self.restrict_idxs.db_insert(rec)
+
+
+	def insert_many(self, recs):
+		new = []
+		for rec in recs:
+			assert self.key_field in rec, "record has not key_field"
+			if self.append(rec):
+				new.append(rec)
+		if 'dbops' in DBGK: logger.debug("insert_many %s %s recs", self.name, len(new))
+		self.restrict_idxs.insert_many(new)
+
+
+	def update_many(self, recs):
+		updated = []
+		for rec in recs:
+			seg, i = self.locate(rec[self.key_field])
+			if seg is None:
+				logger.error("update in %s, no document with %s=%s", self.name, self.key_field, rec[self.key_field])
+				continue
+			updated.append(self.update(seg, i, rec))
+		self.restrict_idxs.update_many(updated)
+
+
+	def db_update(self, rec):
+		""" records are immutable on disk, an update is written to 'updated' """
+		if 'dbops' in DBGK: logger.debug("REC update %s rec %s", self.name, rec)
+		seg, i = self.locate(rec[self.key_field])
+		if seg is None:
+			logger.error("update in %s, no document with %s=%s", self.name, self.key_field, rec[self.key_field])
+			return
+		self.restrict_idxs.db_update(self.update(seg, i, rec))
+
+
+	def db_delete(self, rec):
+		val = rec[self.key_field]
+		if 'dbops' in DBGK: logger.debug("SegLogTable deleting field=%s val=%s", self.key_field, val)
+		self.restrict_idxs.db_delete(rec)
+		seg, i = self.locate(val)
+		if seg is None:
+			logger.error("delete in %s, no document with %s=%s", self.name, self.key_field, val)
+			raise ValueError
+		self.remove(seg, i)
+
+
+	def field_idx(self, field):
+		""" return the DBFieldIndex for field, or None if field is not indexed """
+		if field not in self.index_fields:
+			return None
+		if field not in self.field_idxs:
+			logger.info("SegLogTable %s: building index on %s", self.name, field)
+			self.field_idxs[field] = DBFieldIndex(field, self.key_field, self)
+		return self.field_idxs[field]
+
+
+	def select(self, query):
+		""" generate the records matching a Query
+			'sorted' plans are ranges on the table key, they only read the
+			segments whose key range overlaps
+		"""
+		plan = self.planner.plan(query)
+		if 'dbops' in DBGK: logger.debug("select %s %s: %s", self.name, query, plan)
+		if plan.method in ['primary', 'secondary']:
+			pred = query.preds[plan.pos]
+			keys = pred.values()
+			if plan.method == 'secondary':
+				keys = [key for val in keys for key in self.field_idx(pred.field).lookup(val)]
+			for key in keys:
+				seg, i = self.locate(key)
+				if seg is not None and query.match(self.seg_recs(seg)[i][2]):
+					yield self.seg_recs(seg)[i][2]
+			return
+		if plan.method == 'sorted':
+			pred = query.preds[plan.pos]
+			lo, hi = (None, pred.value) if pred.op in ['<', '<='] else (pred.value, None)
+			segs = [seg for seg in self.segments if seg.has_key_range(lo, hi)]
+		else:
+			segs = list(self.segments)
+		for seg in segs:
+			for key, lineno, rec in list(self.seg_recs(seg)):
+				if query.match(rec):
+					yield rec
+
+
+	def aggregate(self, query, aggs, group_by=None):
+		""" the rows of an Aggregation over the records matching a Query,
+			a range on the table key only reads the segments it overlaps
+		"""
+		return Aggregation(aggs, group_by).add_many(self.select(query)).rows()
+
+
+	def get(self, field, op, val):
+		res = next(self.select(Query.where(field, op, val)), None)
+		if 'dbops' in DBGK: logger.debug("get %s rec %s %s %s: %s", self.name, field, op, val, res)
+		return res
+
+
+	def search(self, field, op, val):
+		res = list(self.select(Query.where(field, op, val)))
+		if 'dbops' in DBGK: logger.debug("search %s rec %s %s %s: %s", self.name, field, op, val, res)
+		return res
+
+
+	def rank(self, key, right=False):
+		""" number of live records with keys < key (<= key if right) """
+		pos = 0
+		for seg in self.segments:
+			if seg.min_key is None:
+				continue
+			if seg.max_key < key or (right and seg.max_key == key):
+				pos += self.seg_live(seg)
+			elif self.block_wise(seg):
+				pos += seg.rank(key, right)
+			elif seg.min_key < key or (right and seg.min_key == key):
+				recs = self.seg_recs(seg)
+				if right:
+					pos += bisect.bisect_right(recs, (key, float('inf')))
+				else:
+					pos += bisect.bisect_left(recs, (key,))
+		return pos
+
+
+	def slice(self, start, stop):
+		""" records at positions start..stop-1, in key order """
+		pos = 0
+		for segs in self.runs():
+			live = sum(self.seg_live(seg) for seg in segs)
+			if pos + live > start and len(segs) == 1 and self.block_wise(segs[0]):
+				yield from segs[0].slice(max(0, start - pos), stop - pos)
+			elif pos + live > start:
+				if len(segs) == 1:
+					recs = self.seg_recs(segs[0])
+				else:
+					recs = list(heapq.merge(*[self.seg_recs(seg) for seg in segs]))
+				for key, lineno, rec in recs[max(0, start - pos):stop - pos]:
+					yield rec
+			pos += live
+			if pos >= stop:
+				break
+
+
+	def get_range(self, csk):
+		""" get a range of records, obeying restrictions
+		unrestricted ranges on the table key are served from the segment
+		index, others use a DBIndex
+		"""
+		if csk.key_field != self.key_field or len(csk.restrict_by) > 0:
+			idx = self.restrict_idxs.get_idx(csk)
+			for rec in idx.get_range(csk):
+				yield dict(rec)
+			return
+
+		if 'get_range' in DBGK: logger.debug("get_range csk %s", str(csk))
+		startv = csk.start_key
+		endv = csk.end_key
+		count = csk.count
+
+		csk.total_item_count = 0
+		total = len(self)
+		if total == 0:
+			return {}
+
+		if csk.cursor_dir is not None:
+			page = csk.cursor_page(self.rank, total)
+			if page is None:
+				if 'get_range' in DBGK: logger.debug("get_range nothing %s the cursor", csk.cursor_dir)
+				return {}
+			sidx, eidx = page
+			count = eidx - sidx + 1
+		else:
+			if startv in [None]:
+				if csk.start_item_number < 0:
+					sidx = max(0, total + csk.start_item_number)
+				else:
+					sidx = min(csk.start_item_number, total - 1)
+			else:
+				sidx = self.rank(startv)
+				if sidx == total:
+					if 'get_range' in DBGK: logger.debug("get_range no start key found")
+					return {}
+
+			if endv in [None]:
+				eidx = min(sidx + count - 1, total - 1)
+			else:
+				eidx = self.rank(endv, right=True) - 1
+				if eidx < 0:
+					if 'get_range' in DBGK: logger.debug("get_range no end key found")
+					return {}
+				count = eidx - sidx + 1
+
+		recs = list(self.slice(sidx, eidx + 1))
+		if len(recs) == 0:
+			return {}
+		csk.start_key = recs[0][self.key_field]
+		csk.end_key = recs[-1][self.key_field]
+		csk.start_item_number = sidx
+		csk.count = count
+		csk.total_item_count = total
+		csk.at_start = sidx == 0
+		csk.at_end = eidx == total - 1
+		csk.set_cursors()
+
+		if 'get_range' in DBGK: logger.debug("get_range size %s", len(recs))
+		for rec in recs:
+			yield dict(rec)  # N.B. the decoded segments are cached, loading an item may modify it
+
+
+	def flush(self):
+		self.compressed()
+		self.segments[-1].flush()
+		if self.deleted_fd is not None:
+			self.deleted_fd.flush()
+		if self.updated_fd is not None:
+			self.updated_fd.flush()
+
+
+	def close(self):
+		self.compressed(wait=True)
+		self.flush()
+		for seg in self.segments:
+			seg.close()
+		if self.deleted_fd is not None:
+			self.deleted_fd.close()
+			self.deleted_fd = None
+		if self.updated_fd is not None:
+			self.updated_fd.close()
+			self.updated_fd = None
+
+
+	def __iter__(self):
+		for seg in self.segments:
+			for key, lineno, rec in self.seg_recs(seg):
+				yield rec
+
+
+	def __len__(self):
+		return self.live_count
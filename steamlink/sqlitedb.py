@@ -0,0 +1,389 @@
+# python library Steamlink
+
+import json
+import logging
+import re
+import sqlite3
+
+from . import (DBG, DBGK)
+from .query import Query, Aggregation
+
+logger = logging.getLogger()
+
+# comparison operators accepted in get/search and restrictions, mapped to SQL
+SQL_OPS = {
+	'==': '=',
+	'!=': '!=',
+	'<':  '<',
+	'<=': '<=',
+	'>':  '>',
+	'>=': '>=',
+	'in': 'IN',
+}
+
+SQL_AGGS = {
+	'count': 'COUNT',
+	'sum':   'SUM',
+	'min':   'MIN',
+	'max':   'MAX',
+	'mean':  'AVG',
+}
+
+
+#
+# SQLiteDB
+#
+class SQLiteDB:
+	""" one sqlite database file in WAL mode, shared by all SQLiteTables
+		writes are grouped in a transaction that is committed on flush()
+	"""
+
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.conn = sqlite3.connect(filename, check_same_thread=False)  # a DBWriter may write
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+
+
+	def execute(self, sql, args=()):
+		if 'dbops' in DBGK: logger.debug("SQLiteDB execute %s %s", sql, args)
+		return self.conn.execute(sql, args)
+
+
+	def executemany(self, sql, rows):
+		if 'dbops' in DBGK: logger.debug("SQLiteDB executemany %s, %s rows", sql, len(rows))
+		return self.conn.executemany(sql, rows)
+
+
+	def commit(self):
+		self.conn.commit()
+
+
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
+		self.conn = None
+
+
+#
+# SQLiteTable
+#
+class SQLiteTable:
+	""" DBTable interface on top of a sqlite table
+		records are kept as json documents, the key_field is a separate
+		primary key column, so inserts and key lookups are O(log n)
+		fields listed in indexes get an sqlite index on their json value,
+		(field, key_field) tuples a composite one, e.g. for per-node ranges
+	"""
+
+
+	def __init__(self, db, name, key_field, indexes=()):
+		if DBG > 2: logger.debug("SQLiteTable %s", name)
+		self.db = db
+		self.name = name
+		self.key_field = key_field
+		self.tname = '"%s"' % name.replace('"', '""')
+		self.db.execute("CREATE TABLE IF NOT EXISTS %s (key PRIMARY KEY, doc TEXT NOT NULL)" % self.tname)
+		for field in indexes:
+			fields = [field] if isinstance(field, str) else list(field)
+			exprs = [self.field_expr(f)[0] for f in fields]
+			self.db.execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON %s (%s)' % (name, "_".join(fields), self.tname,
+																			 ", ".join(exprs)))
+		self.count = self.db.execute("SELECT COUNT(*) FROM %s" % self.tname).fetchone()[0]
+		self.compiled = {}
+
+
+	def field_expr(self, field):
+		""" return sql expression and args for a record field
+			plain field names are inlined, so sqlite can match them to an index
+		"""
+		if field == self.key_field:
+			return "key", ()
+		if re.match(r'^\w+$', field):
+			return "json_extract(doc, '$.%s')" % field, ()
+		return "json_extract(doc, ?)", ("$." + field,)
+
+
+	def where(self, query):
+		""" return sql condition and args for a Query
+			conditions are cached by query shape and the size of 'in' lists
+		"""
+		sizes = tuple([len(p.value) for p in query.preds if p.op == 'in'])
+		cache_key = (query.shape, sizes)
+		cond, fargs = self.compiled.get(cache_key, (None, None))
+		if cond is None:
+			conds = []
+			fargs = []
+			for pred in query.preds:
+				try:
+					sql_op = SQL_OPS[pred.op]
+				except KeyError:
+					logger.error("SQLiteTable %s: unsupported op '%s'", self.name, pred.op)
+					raise ValueError("unsupported op '%s'" % pred.op)
+				expr, args = self.field_expr(pred.field)
+				if pred.op == 'in':
+					conds.append("%s IN (%s)" % (expr, ", ".join(["?"] * len(pred.value))))
+				else:
+					conds.append("%s %s ?" % (expr, sql_op))
+				fargs.append(args)
+			cond = " AND ".join(conds) if len(conds) > 0 else "1"
+			self.compiled[cache_key] = (cond, fargs)
+		args = ()
+		for pred, pargs in zip(query.preds, fargs):
+			args += pargs + (tuple(pred.value) if pred.op == 'in' else (pred.value,))
+		return cond, args
+
+
+	def restrictions(self, csk):
+		""" return sql condition and args for the restrictions of a CSearchKey """
+		return self.where(csk.restrict_query)
+
+
+	def db_insert(self, rec):
+		assert self.key_field in rec, "record has not key_field"
+		r = rec[self.key_field]
+		try:
+			self.db.execute("INSERT INTO %s (key, doc) VALUES (?, ?)" % self.tname, (r, json.dumps(rec)))
+		except sqlite3.IntegrityError:
+			logger.error("duplicate record %s, rec %s, %s", self.name, r, rec)
+			return
+		self.count += 1
+		if 'dbops' in DBGK: logger.debug("insert %s rec %s", self.name, rec)
+
+
+	def insert_many(self, recs):
+		""" insert a batch of records with one statement, duplicates are skipped """
+		for rec in recs:
+			assert self.key_field in rec, "record has not key_field"
+		cur = self.db.executemany("INSERT OR IGNORE INTO %s (key, doc) VALUES (?, ?)" % self.tname,
+								  [(rec[self.key_field], json.dumps(rec)) for rec in recs])
+		if cur.rowcount < len(recs):
+			logger.error("insert_many %s: %s duplicate records", self.name, len(recs) - cur.rowcount)
+		self.count += cur.rowcount
+		if 'dbops' in DBGK: logger.debug("insert_many %s %s recs", self.name, cur.rowcount)
+
+
+	def merged(self, recs):
+		""" (doc, key) rows of recs merged into their stored documents, as DBTable does,
+			records without a stored document are skipped
+		"""
+		rows = []
+		for rec in recs:
+			key = rec[self.key_field]
+			row = self.db.execute("SELECT doc FROM %s WHERE key = ?" % self.tname, (key,)).fetchone()
+			if row is None:  # e.g. deleted by retention
+				if 'dbops' in DBGK: logger.debug("update in %s, no document with %s=%s", self.name, self.key_field, key)
+				continue
+			doc = json.loads(row[0])
+			doc.update(rec)
+			rows.append((json.dumps(doc), key))
+		return rows
+
+
+	def update_many(self, recs):
+		if 'dbops' in DBGK: logger.debug("update_many %s %s recs", self.name, len(recs))
+		self.db.executemany("UPDATE %s SET doc = ? WHERE key = ?" % self.tname, self.merged(recs))
+
+
+	def db_update(self, rec):
+		if 'dbops' in DBGK: logger.debug("REC update %s rec %s", self.name, rec)
+		self.db.executemany("UPDATE %s SET doc = ? WHERE key = ?" % self.tname, self.merged([rec]))
+
+
+	def db_delete(self, rec):
+		val = rec[self.key_field]
+		if 'dbops' in DBGK: logger.debug("SQLiteTable deleting field=%s val=%s", self.key_field, val)
+		cur = self.db.execute("DELETE FROM %s WHERE key = ?" % self.tname, (val,))
+		if cur.rowcount == 0:
+			logger.error("delete in %s, no document with %s=%s", self.name, self.key_field, val)
+			raise ValueError
+		self.count -= cur.rowcount
+
+
+	def key_at(self, pos):
+		""" the key at position pos in key order, None if pos is past the end """
+		row = self.db.execute("SELECT key FROM %s ORDER BY key LIMIT 1 OFFSET ?" % self.tname, (pos,)).fetchone()
+		return None if row is None else row[0]
+
+
+	def delete_before(self, key, inclusive=False):
+		""" delete the records with keys < key (<= key if inclusive), return their number """
+		op = "<=" if inclusive else "<"
+		cur = self.db.execute("DELETE FROM %s WHERE key %s ?" % (self.tname, op), (key,))
+		self.count -= cur.rowcount
+		if 'dbops' in DBGK: logger.debug("delete_before %s %s: %s recs", self.name, key, cur.rowcount)
+		return cur.rowcount
+
+
+	def size_bytes(self):
+		""" estimated size of the records as json """
+		row = self.db.execute("SELECT AVG(LENGTH(doc)) FROM (SELECT doc FROM %s LIMIT 100)" % self.tname).fetchone()
+		return 0 if row[0] is None else int(row[0] * self.count)
+
+
+	def get(self, field, op, val):
+		cond, args = self.where(Query.where(field, op, val))
+		row = self.db.execute("SELECT doc FROM %s WHERE %s LIMIT 1" % (self.tname, cond), args).fetchone()
+		res = None if row is None else json.loads(row[0])
+		if 'dbops' in DBGK: logger.debug("get %s rec %s %s %s: %s", self.name, field, op, val, res)
+		return res
+
+
+	def aggregate(self, query, aggs, group_by=None):
+		""" the rows of an Aggregation over the records matching a Query,
+			computed by sqlite
+		"""
+		agg = Aggregation(aggs, group_by)
+		cols = []
+		args = ()
+		for op, field in agg.aggs:
+			if field is None:
+				cols.append("COUNT(*)")
+				continue
+			expr, eargs = self.field_expr(field)
+			cols.append("%s(%s)" % (SQL_AGGS[op], expr))
+			args += eargs
+		cond, cargs = self.where(query)
+		if group_by is None:
+			sql = "SELECT %s FROM %s WHERE %s" % (", ".join(cols), self.tname, cond)
+			args += cargs
+		else:
+			gexpr, gargs = self.field_expr(group_by)
+			sql = "SELECT %s, %s FROM %s WHERE %s GROUP BY %s ORDER BY %s" % (
+				gexpr, ", ".join(cols), self.tname, cond, gexpr, gexpr)
+			args = gargs + args + cargs + gargs + gargs
+		rows = []
+		for row in self.db.execute(sql, args):
+			res = {} if group_by is None else {group_by: row[0]}
+			for (op, field), val in zip(agg.aggs, row[len(row) - len(cols):]):
+				res[Aggregation.name(op, field)] = val
+			rows.append(res)
+		if 'dbops' in DBGK: logger.debug("aggregate %s %s %s by %s: %s rows", self.name, query, aggs, group_by, len(rows))
+		return rows
+
+
+	def search(self, field, op, val):
+		cond, args = self.where(Query.where(field, op, val))
+		res = [json.loads(row[0]) for row in
+			   self.db.execute("SELECT doc FROM %s WHERE %s" % (self.tname, cond), args)]
+		if 'dbops' in DBGK: logger.debug("search %s rec %s %s %s: %s", self.name, field, op, val, res)
+		return res
+
+
+	def cursor_range(self, csk, kexpr, kargs, rcond, rargs):
+		""" rows of the page at the cursor of csk and (first, last, total) positions
+			the page is found by seeking to the cursor key, one row more tells
+			if there is a page beyond it, and for 'prev' one lookup if there are
+			rows after it; nothing is counted, so a page costs
+			O(log n + count): the first position is the one the client sent in
+			start_item_number, and with restrictions the total is a lower bound
+		"""
+		count = max(0, csk.count)
+		op, order = ('>', 'ASC') if csk.cursor_dir == 'next' else ('<', 'DESC')
+		sql = "SELECT %s, doc FROM %s WHERE %s AND %s %s ? ORDER BY %s %s LIMIT ?" % (
+			kexpr, self.tname, rcond, kexpr, op, kexpr, order)
+		rows = self.db.execute(sql, kargs + rargs + kargs + (csk.cursor_key,) + kargs + (count + 1,)).fetchall()
+		more = len(rows) > count
+		rows = rows[:count]
+		if order == 'DESC':
+			rows.reverse()
+		if len(rows) == 0:
+			return rows, None
+
+		if csk.cursor_dir == 'next':  # the cursor row is before the page
+			sidx = max(1, csk.start_item_number)
+			after = more
+		else:  # and after it, if there is one
+			sidx = 0 if not more else max(1, csk.start_item_number)
+			sql = "SELECT 1 FROM %s WHERE %s AND %s >= ? LIMIT 1" % (self.tname, rcond, kexpr)
+			after = self.db.execute(sql, rargs + kargs + (csk.cursor_key,)).fetchone() is not None
+		total = sidx + len(rows) + (1 if after else 0)
+		if len(csk.restrict_by) == 0:
+			total = self.count
+			if not after:
+				sidx = total - len(rows)
+			sidx = max(0, min(sidx, total - len(rows)))
+		return rows, (sidx, sidx + len(rows) - 1, total)
+
+
+	def get_range(self, csk):
+		""" get a range of records, obeying restrictions
+		same semantics as DBTable.get_range, but positions are computed by
+		sqlite; a page at a cursor is not counted, see cursor_range
+		"""
+		if 'get_range' in DBGK: logger.debug("get_range csk %s", str(csk))
+		startv = csk.start_key
+		endv = csk.end_key
+		count = csk.count
+
+		csk.total_item_count = 0
+
+		kexpr, kargs = self.field_expr(csk.key_field)
+		rcond, rargs = self.restrictions(csk)
+
+		def count_where(cond="1", args=()):
+			sql = "SELECT COUNT(*) FROM %s WHERE %s AND %s" % (self.tname, rcond, cond)
+			return self.db.execute(sql, rargs + args).fetchone()[0]
+
+		def rank(key, right):
+			return count_where("%s %s ?" % (kexpr, '<=' if right else '<'), kargs + (key,))
+
+		if csk.cursor_dir is not None:
+			rows, page = self.cursor_range(csk, kexpr, kargs, rcond, rargs)
+			if page is None:
+				if 'get_range' in DBGK: logger.debug("get_range nothing %s the cursor", csk.cursor_dir)
+				return {}
+			sidx, eidx, total = page
+			count = eidx - sidx + 1
+		else:
+			total = count_where()
+			if total == 0:
+				if 'get_range' in DBGK: logger.debug("get_range table empty after destrict")
+				return {}
+
+			if startv in [None]:
+				if csk.start_item_number < 0:
+					sidx = max(0, total + csk.start_item_number)
+				else:
+					sidx = min(csk.start_item_number, total - 1)
+			else:
+				sidx = rank(startv, False)
+				if sidx == total:
+					if 'get_range' in DBGK: logger.debug("get_range no start key found")
+					return {}
+
+			if endv in [None]:
+				eidx = min(sidx + count - 1, total - 1)
+			else:
+				eidx = rank(endv, True) - 1
+				if eidx < 0:
+					if 'get_range' in DBGK: logger.debug("get_range no end key found")
+					return {}
+				count = eidx - sidx + 1
+
+			sql = "SELECT %s, doc FROM %s WHERE %s ORDER BY %s LIMIT ? OFFSET ?" % (kexpr, self.tname, rcond, kexpr)
+			rows = self.db.execute(sql, kargs + rargs + kargs + (max(0, eidx - sidx + 1), sidx)).fetchall()
+		if len(rows) == 0:
+			return {}
+
+		csk.start_key = rows[0][0]
+		csk.end_key = rows[-1][0]
+		csk.start_item_number = sidx
+		csk.count = count
+		csk.total_item_count = total
+		csk.at_start = sidx == 0
+		csk.at_end = eidx == total - 1
+		csk.set_cursors()
+
+		if 'get_range' in DBGK: logger.debug("get_range size %s", len(rows))
+		for row in rows:
+			yield json.loads(row[1])
+
+
+	def flush(self):
+		pass
+
+
+	def __len__(self):
+		return self.count
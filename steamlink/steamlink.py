@@ -16,6 +16,8 @@ from . import (DBG, DBGK)
 from .util import phex
 from .const import PROJECT_PACKAGE_NAME, __version__
 from .linkage import Item, Table, DbBackedTable, CSearchKey
+from .query import Query, Pred
+from .rollup import Rollup
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +27,7 @@ SL_ACK_WAIT = 3
 
 _MQTT = None
 _DB = None
+_ROLLUPS = None
 steam_root = None
 
 
@@ -40,6 +43,11 @@ def set_steam_root(root):
 	steam_root = root
 
 
+def set_rollups(rollups):
+	global _ROLLUPS
+	_ROLLUPS = rollups
+
+
 TODO = """
 - track routing table from received packets
 
@@ -292,6 +300,7 @@ class Steam(Item):
 		self.my_ip_address = socket.gethostbyname(socket.gethostname())
 		self.identity = "%s %s (%s)" % (PROJECT_PACKAGE_NAME, __version__, self.my_ip_address)
 		self._public_topic_control_re = None
+		self._retention = None  # set by main
 
 		_MQTT.set_msg_callback(self.on_data_msg)
 
@@ -458,7 +467,8 @@ class Steam(Item):
 			self.heartbeat()
 			flushwait -= 1
 			if flushwait == 0:
-				_DB.flush()  # N.B. expensive
+				Packet._table.insert_pending()
+				_DB.flush()  # journals changed records
 				flushwait = FLUSHWAIT
 
 			n_process_time = time.process_time()
@@ -492,6 +502,22 @@ class Steam(Item):
 			r['Mesh records'] = len(Mesh._table)
 			r['Node records'] = len(Node._table)
 			r['Packet records'] = len(Packet._table)
+			db_status = _DB.status()
+			if len(db_status) > 0:
+				r['DB write queue'] = db_status['queue']
+				r['DB write lag'] = "%.3fs (max %.3fs)" % (db_status['lag'], db_status['max_lag'])
+			index_stats = _DB.index_stats()
+			for name in index_stats:
+				s = index_stats[name]
+				r[name + ' indexes'] = "%s (%s keys, %s held), %s hits %s misses %s evicted" % (
+					s['indexes'], s['keys'], s['held'], s['hits'], s['misses'], s['evictions'])
+			if self._retention is not None:
+				reclaimed = self._retention.status()
+				for name in reclaimed:
+					r[name + ' reclaimed'] = "%s records, %s bytes" % (reclaimed[name]['rows'], reclaimed[name]['bytes'])
+			if _ROLLUPS is not None:
+				s = _ROLLUPS.status()
+				r['Rollups'] = "%s nodes, %s records, %s pending" % (s['nodes'], len(Rollup._table), s['dirty'])
 		return r
 
 
@@ -789,6 +815,8 @@ class Node(Item):
 		if pkt_num != 1:  # remote restarted
 			missed = pkt_num - (last_packet_num + 1)
 			self.packets_missed += missed
+			if _ROLLUPS is not None:
+				_ROLLUPS.add(self.slid, sl_pkt.ts, missed=missed)
 			logger.error("%s: %s pkts missed before %s", self, missed, sl_pkt)
 		return False
 
@@ -799,7 +827,9 @@ class Node(Item):
 			return
 		if DBG >= 1: logger.debug("store_data inserting into db")
 
-		sl_pkt.insert()
+		Packet._table.insert_batched(sl_pkt)  # bursts are written as one batch
+		if _ROLLUPS is not None:
+			_ROLLUPS.add(self.slid, sl_pkt.ts, rssi=sl_pkt.rssi, packets=1)
 		self.send_ack_to_node(0)
 		try:
 			payload = json.dumps(sl_pkt.payload)
@@ -817,6 +847,8 @@ class Node(Item):
 					self.send_ack_to_node(0)
 				self.packets_duplicate += 1
 				self.packets_dropped += 1
+				if _ROLLUPS is not None:
+					_ROLLUPS.add(self.slid, sl_pkt.ts, duplicates=1)
 				return  # duplicate
 		else:
 			logger.error("%s got control pkt %s", self, sl_pkt)
@@ -1091,6 +1123,13 @@ class BasePacket:
 # Packet
 #
 class Packet(BasePacket, Item):
+	# columns of the ColumnArchive packets are moved to by Retention
+	archive_columns = [('ts', 'd'), ('slid', 'q'), ('rssi', 'i'), ('sl_op', 'B'), ('pkt_num', 'i')]
+	archive_side = ['via', 'payload']
+	archive_encode = {'sl_op': SL_OP.val}
+	archive_decode = {'sl_op': SL_OP.code}
+
+
 	def __init__(self, slnode=None, sl_op=None, rssi=0, payload=None, pkt=None, _load=None):
 
 		BasePacket.__init__(self, slnode, sl_op, rssi, payload, pkt)
@@ -1282,6 +1321,7 @@ class LogData:
 	 'start_item_number':
 	 'end_key':
 	 'count':
+	 'cursor':
 	 'stream_tag':
   }
 """
@@ -1316,10 +1356,58 @@ def add_csearch(webnamespace, sid, message):
 		'total_item_count':  csearchkey.total_item_count,
 		'at_start':          csearchkey.at_start,
 		'at_end':            csearchkey.at_end,
+		'next_cursor':       csearchkey.next_cursor,
+		'prev_cursor':       csearchkey.prev_cursor,
 	}
 	return res
 
 
+"""
+ message = {
+	 'table_name':
+	 'key_field':	 default the table's key field
+	 'restrict_by':
+	 'start_key':	 range of key_field, either may be null
+	 'end_key':
+	 'since':		 seconds, instead of start_key for tables keyed by time stamp
+	 'aggs':		 list of [op, field], op is count, sum, min, max or mean,
+					 field can be left out for count
+	 'group_by':	 field, e.g. slid or sl_op, or null
+  }
+"""
+
+
+async def run_aggregate(webnamespace, sid, message):
+	table_name = message['table_name']
+	try:
+		table = Table.tables[table_name]
+	except KeyError as e:
+		return {'error': 'Table %s not found. Availabe are %s' % (str(e), list(Table.tables.keys()))}
+
+	key_field = message.get('key_field') or table.keyfield
+	start_key = message.get('start_key')
+	end_key = message.get('end_key')
+	if message.get('since') is not None:
+		start_key = time.time() - float(message['since'])
+	try:
+		preds = [Pred(r['field_name'], r['op'], r['value']) for r in message.get('restrict_by') or []]
+		if start_key is not None:
+			preds.append(Pred(key_field, '>=', float(start_key) if key_field == 'ts' else start_key))
+		if end_key is not None:
+			preds.append(Pred(key_field, '<=', float(end_key) if key_field == 'ts' else end_key))
+		aggs = [(agg[0], agg[1] if len(agg) > 1 else None) for agg in message.get('aggs') or [['count']]]
+		table.insert_pending()
+		await _DB.caught_up()  # write_behind: include the queued writes
+		rows = table.aggregate(Query(preds), aggs, message.get('group_by'))
+	except (KeyError, TypeError, ValueError) as e:
+		msg = 'aggregate failed: %s' % e
+		logger.info('run_aggregate %s: %s', table_name, msg)
+		return {'error': msg}
+
+	if DBG > 1: logger.debug("run_aggregate sid %s %s: %s", sid, message, rows)
+	return {'rows': rows}
+
+
 def drop_csearch(webnamespace, sid, message):
 	table_name = message.get('table_name', None)
 	if table_name == None:  # all all tables, i.e. disconnect
@@ -1346,5 +1434,6 @@ def run_cmd(webnamespace, sid, message):
 def SteamSetup():
 	Steam._table = DbBackedTable(Steam, keyfield="steam_id", tablename="Steam")
 	Mesh._table = DbBackedTable(Mesh, keyfield="mesh_id", tablename="Mesh")
-	Node._table = DbBackedTable(Node, keyfield="slid", tablename="Node")
-	Packet._table = DbBackedTable(Packet, keyfield="ts", tablename="Packet")
+	Node._table = DbBackedTable(Node, keyfield="slid", tablename="Node", indexes=['name', 'mesh_id'])
+	Packet._table = DbBackedTable(Packet, keyfield="ts", tablename="Packet", indexes=['slid', 'sl_op', ('slid', 'ts')])
+	Rollup._table = DbBackedTable(Rollup, keyfield="rid", tablename="Rollup", indexes=['slid'])
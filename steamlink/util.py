@@ -87,6 +87,9 @@ def getargs():
 	parser.add_argument("-C", "--createconfig",
 						help="write default config file and exit",
 						default=False, action='store_true')
+	parser.add_argument("-S", "--seglog-stats",
+						help="print compression ratio and decode throughput of the segment logs and exit",
+						default=False, action='store_true')
 	parser.add_argument("-p", "--pid-file",
 						help="path to pid file when running as daemon",
 						default=None)
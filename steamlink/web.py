@@ -16,7 +16,7 @@ from zeroconf import ServiceInfo, Zeroconf
 
 from .const import __version__
 from . import (DBGK)
-from .steamlink import add_csearch, run_cmd, drop_csearch
+from .steamlink import add_csearch, run_cmd, drop_csearch, run_aggregate
 
 logger = logging.getLogger(__name__)
 
@@ -116,6 +116,13 @@ class WebNamespace(socketio.AsyncNamespace):
 		return res
 
 
+	async def on_aggregate(self, sid, message):
+		logger.debug("WebNamespace on_aggregate --> %s", message)
+		res = await run_aggregate(self, sid, message)
+		logger.debug("WebNamespace on_aggregate <-- %s", res)
+		return res
+
+
 	async def on_leave(self, sid, message):
 
 		logger.debug("WebNamespace on_leave %s", message)
@@ -265,7 +272,7 @@ class WebApp(object):
 
 
 	def queue_itemlist_update(self, csitems, force):
-		if 'webupd' in DBGK: logger.debug("queue_itemlist_update for %s item %s", csitem.csearch.search_id, csitem.item)
+		if 'webupd' in DBGK: logger.debug("queue_itemlist_update for %s %s items", csitems[0].csearch.search_id, len(csitems))
 		asyncio.ensure_future(self.con_upd_q.put([csitems, force]), loop=self.loop)
 
 
@@ -0,0 +1,345 @@
+# python library Steamlink
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from . import (DBG, DBGK)
+from .query import Query
+
+logger = logging.getLogger()
+
+
+#
+# DBWriter
+#
+class DBWriter:
+	""" applies DB mutations in a thread, fed by a bounded queue
+		submit() blocks when the queue is full, that is counted in full_waits
+		the lock is held while a mutation is applied, readers of the tables
+		take it too, so it must not be held over disk I/O: submit_io() queues
+		work that runs without it, and the after() functions, e.g. writing
+		the journals, run without it after each mutation
+	"""
+
+
+	def __init__(self, max_queue):
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.lock = threading.RLock()
+		self.thread = threading.Thread(target=self.run, name="DBWriter", daemon=True)
+		self.seqno = 0  # last submitted
+		self.applied = 0  # last applied
+		self.applied_cond = threading.Condition()
+		self.pending_ts = deque()  # submit times of the queued mutations
+		self.after_fns = []
+		self.full_waits = 0
+		self.errors = 0
+		self.max_lag = 0.0
+
+
+	def start(self):
+		self.thread.start()
+
+
+	def after(self, fn):
+		""" call fn() in the writer after each mutation, without the lock """
+		self.after_fns.append(fn)
+
+
+	def put(self, fn, args, locked=True, future=None):
+		self.seqno += 1
+		if self.queue.full():
+			self.full_waits += 1
+			logger.warning("DBWriter queue full, %s mutations pending", self.queue.qsize())
+		self.pending_ts.append(time.time())
+		self.queue.put((self.seqno, fn, args, locked, future))
+		return self.seqno
+
+
+	def submit(self, fn, *args):
+		""" queue fn(*args) for the writer, return its seqno """
+		return self.put(fn, args)
+
+
+	def submit_io(self, fn, *args):
+		""" queue fn(*args), which does not change the tables, to run without the lock """
+		return self.put(fn, args, locked=False)
+
+
+	def call(self, fn, *args):
+		""" queue fn(*args) for the writer, return a concurrent Future of its result """
+		future = Future()
+		self.put(fn, args, future=future)
+		return future
+
+
+	def run(self):
+		while True:
+			seqno, fn, args, locked, future = self.queue.get()
+			if fn is None:
+				self.queue.task_done()
+				break
+			try:
+				if locked:
+					with self.lock:
+						res = fn(*args)
+				else:
+					res = fn(*args)
+				if future is not None:
+					future.set_result(res)
+			except Exception as e:
+				self.errors += 1
+				logger.error("DBWriter %s%s failed: %s", fn.__name__, args[:1], e)
+				if future is not None:
+					future.set_exception(e)
+			for after_fn in self.after_fns:
+				try:
+					after_fn()
+				except Exception as e:
+					self.errors += 1
+					logger.error("DBWriter %s failed: %s", after_fn.__name__, e)
+			self.max_lag = max(self.max_lag, time.time() - self.pending_ts.popleft())
+			with self.applied_cond:
+				self.applied = seqno
+				self.applied_cond.notify_all()
+			self.queue.task_done()
+
+
+	def wait(self, seqno):
+		""" wait until mutation seqno is applied, not on the event loop """
+		with self.applied_cond:
+			self.applied_cond.wait_for(lambda: self.applied >= seqno)
+
+
+	def sync(self):
+		""" wait until all submitted mutations are applied, on shutdown """
+		self.queue.join()
+
+
+	def stop(self):
+		self.queue.put((None, None, None, False, None))
+		self.thread.join()
+
+
+	def lag(self):
+		""" age in seconds of the oldest mutation not applied yet """
+		try:
+			return time.time() - self.pending_ts[0]
+		except IndexError:
+			return 0.0
+
+
+	def status(self):
+		return {
+			'queue':      self.queue.qsize(),
+			'lag':        self.lag(),
+			'max_lag':    self.max_lag,
+			'full_waits': self.full_waits,
+			'errors':     self.errors,
+		}
+
+
+#
+# WriteBehindTable
+#
+class WriteBehindTable:
+	""" DBTable interface in front of a table that is written by a DBWriter
+		mutations are queued for the writer and kept in an overlay until
+		they are applied, get and search merge the overlay into the results
+		reads never wait for the writer:
+		- get_range merges the overlay into the records of the range, records
+		  inserted since are not in it until they are applied, they reach the
+		  web console through its CSearches
+		- aggregate and key_at see the applied records, await DB.caught_up()
+		  first to include the queued mutations
+		- delete_before is queued, it returns an asyncio future of the count
+	"""
+
+
+	def __init__(self, table, writer):
+		self.table = table
+		self.writer = writer
+		self.name = table.name
+		self.key_field = table.key_field
+		self.overlay = OrderedDict()  # key -> (seqno, op, rec), in seqno order
+
+
+	def prune(self):
+		""" drop overlay entries the writer has applied """
+		applied = self.writer.applied
+		while len(self.overlay) > 0:
+			key, (seqno, op, rec) = next(iter(self.overlay.items()))
+			if seqno > applied:
+				break
+			del self.overlay[key]
+
+
+	def stage(self, seqno, op, key, rec):
+		""" add a mutation to the overlay, op is 'put', 'upd' or 'del' """
+		prev = self.overlay.pop(key, None)
+		if op == 'upd' and prev is not None:
+			if prev[1] == 'del':
+				op, rec = 'del', None
+			else:
+				merged = dict(prev[2])
+				merged.update(rec)
+				op, rec = prev[1], merged
+		self.overlay[key] = (seqno, op, rec)
+
+
+	def resolve(self, key, base=None):
+		""" the record for key as seen with the overlay, None if deleted
+			base is the record in the table, it is read if needed and not given
+		"""
+		seqno, op, rec = self.overlay[key]
+		if op == 'del':
+			return None
+		if op == 'put':
+			return dict(rec)
+		if base is None:
+			with self.writer.lock:
+				base = self.table.get(self.key_field, '==', key)
+			if base is None:
+				return None
+		res = dict(base)
+		res.update(rec)
+		return res
+
+
+	def db_insert(self, rec):
+		rec = dict(rec)
+		self.prune()
+		seqno = self.writer.submit(self.table.db_insert, rec)
+		self.stage(seqno, 'put', rec[self.key_field], rec)
+
+
+	def db_update(self, rec):
+		rec = dict(rec)
+		self.prune()
+		seqno = self.writer.submit(self.table.db_update, rec)
+		self.stage(seqno, 'upd', rec[self.key_field], rec)
+
+
+	def db_delete(self, rec):
+		rec = dict(rec)
+		self.prune()
+		seqno = self.writer.submit(self.table.db_delete, rec)
+		self.stage(seqno, 'del', rec[self.key_field], None)
+
+
+	def insert_many(self, recs):
+		recs = [dict(rec) for rec in recs]
+		self.prune()
+		seqno = self.writer.submit(self.table.insert_many, recs)
+		for rec in recs:
+			self.stage(seqno, 'put', rec[self.key_field], rec)
+
+
+	def update_many(self, recs):
+		recs = [dict(rec) for rec in recs]
+		self.prune()
+		seqno = self.writer.submit(self.table.update_many, recs)
+		for rec in recs:
+			self.stage(seqno, 'upd', rec[self.key_field], rec)
+
+
+	def key_at(self, pos):
+		with self.writer.lock:
+			return self.table.key_at(pos)
+
+
+	def delete_before(self, key, inclusive=False):
+		""" queue a bulk delete, return an asyncio future of the number deleted """
+		self.prune()
+		return asyncio.wrap_future(self.writer.call(self.table.delete_before, key, inclusive))
+
+
+	def size_bytes(self):
+		with self.writer.lock:
+			return self.table.size_bytes()
+
+
+	def get(self, field, op, val):
+		self.prune()
+		if field == self.key_field and op == '==' and val in self.overlay:
+			return self.resolve(val)
+		if len(self.overlay) == 0:
+			with self.writer.lock:
+				return self.table.get(field, op, val)
+		return next(iter(self.search(field, op, val)), None)
+
+
+	def search(self, field, op, val):
+		self.prune()
+		with self.writer.lock:
+			recs = self.table.search(field, op, val)
+		if len(self.overlay) == 0:
+			return recs
+		query = Query.where(field, op, val)
+		res = []
+		seen = set()
+		for rec in recs:
+			key = rec[self.key_field]
+			if key in self.overlay:
+				seen.add(key)
+				rec = self.resolve(key, rec)
+				if rec is None or not query.match(rec):
+					continue
+			res.append(rec)
+		for key in list(self.overlay):
+			if key not in seen:
+				rec = self.resolve(key)
+				if rec is not None and query.match(rec):
+					res.append(rec)
+		if 'dbops' in DBGK: logger.debug("search %s rec %s %s %s: %s", self.name, field, op, val, res)
+		return res
+
+
+	def aggregate(self, query, aggs, group_by=None):
+		if 'dbops' in DBGK: logger.debug("aggregate %s, %s mutations not applied", self.name, len(self.overlay))
+		with self.writer.lock:
+			return self.table.aggregate(query, aggs, group_by)
+
+
+	def get_range(self, csk):
+		self.prune()
+		with self.writer.lock:
+			recs = list(self.table.get_range(csk))
+		if len(self.overlay) == 0:
+			yield from recs
+			return
+		if 'get_range' in DBGK: logger.debug("get_range %s, merging %s mutations", self.name, len(self.overlay))
+		for rec in recs:
+			key = rec[self.key_field]
+			if key in self.overlay:
+				rec = self.resolve(key, rec)
+				if rec is None or not csk.check_restrictions(rec):
+					continue
+			yield rec
+
+
+	def flush(self):
+		self.writer.submit(self.table.flush)
+
+
+	def close(self):
+		""" on shutdown, the queued mutations are applied first """
+		self.writer.sync()
+		with self.writer.lock:
+			self.table.close()
+
+
+	def __len__(self):
+		""" approximate while mutations are pending: inserts of existing keys count """
+		self.prune()
+		count = len(self.table)
+		for seqno, op, rec in list(self.overlay.values()):
+			if op == 'put':
+				count += 1
+			elif op == 'del':
+				count -= 1
+		return count
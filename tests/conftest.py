@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steamlink.db import DB
+
+
+@pytest.fixture
+def loop():
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	yield loop
+	loop.close()
+	asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def open_db(tmp_path, loop):
+	""" open_db(backend, **conf) starts a DB in tmp_path, 'seglog' is tinydb with
+		table P in a segment log; the DBs are closed after the test, except
+		the ones passed to open_db.crash(), which are dropped as if the
+		process died
+	"""
+	dbs = []
+
+	def open_db(backend='tinydb', **conf):
+		full = {
+			'backend':         'tinydb' if backend == 'seglog' else backend,
+			'db_filename':     str(tmp_path / 'steamlink.db'),
+			'sqlite_filename': str(tmp_path / 'steamlink.sqlite'),
+			'seglog_dir':      str(tmp_path / 'seglog'),
+			'seglog_tables':   ['P'] if backend == 'seglog' else [],
+			'lazy_tables':     [],
+		}
+		full.update(conf)
+		db = DB(full, loop)
+		loop.run_until_complete(db.start())
+		dbs.append(db)
+		return db
+
+	def crash(db):
+		dbs.remove(db)
+		if db.writer is not None:
+			db.writer.stop()
+		db.executor.shutdown()
+
+	open_db.crash = crash
+	yield open_db
+	for db in dbs:
+		if db.db is not None:
+			db.close()
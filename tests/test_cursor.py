@@ -0,0 +1,69 @@
+import pytest
+
+from steamlink.linkage import CSearchKey
+
+BACKENDS = ['tinydb', 'sqlite', 'seglog']
+RESTRICTIONS = {
+	'all':   [],
+	'eq':    [{'field_name': 'slid', 'op': '==', 'value': 1}],
+	'range': [{'field_name': 'slid', 'op': '>', 'value': 0}],
+}
+
+
+@pytest.fixture(params=BACKENDS)
+def table(request, open_db):
+	table = open_db(request.param, segment_records=30).table('P', 'ts', indexes=['slid', ('slid', 'ts')])
+	table.insert_many([{'ts': float(i), 'slid': i % 3} for i in range(0, 400, 2)])
+	return table
+
+
+def page(table, cursor, restrict_by, count=10):
+	csk = CSearchKey('P', 'ts', None, 0, count, restrict_by=restrict_by, cursor=cursor)
+	return [rec['ts'] for rec in table.get_range(csk)], csk
+
+
+def matching(table, restrict_by):
+	query = CSearchKey('P', 'ts', None, 0, 1, restrict_by=restrict_by)
+	return sorted(rec['ts'] for rec in table.search('ts', '>=', 0) if query.check_restrictions(rec))
+
+
+@pytest.mark.parametrize('restrict', list(RESTRICTIONS))
+def test_next_pages_not_shifted_by_inserts(table, restrict):
+	""" records inserted before the cursor do not shift the following pages """
+	restrict_by = RESTRICTIONS[restrict]
+	before = matching(table, restrict_by)
+	seen, csk = page(table, None, restrict_by)
+	assert csk.at_start
+	while not csk.at_end:
+		if len(seen) == 30:
+			table.db_insert({'ts': 1.0, 'slid': 1})  # behind the cursor, e.g. a late packet
+			table.db_insert({'ts': 1000.0, 'slid': 1})  # arriving
+		keys, csk = page(table, csk.next_cursor, restrict_by)
+		assert len(keys) > 0
+		seen += keys
+	assert seen == [k for k in matching(table, restrict_by) if k in before or k == 1000.0]
+
+
+@pytest.mark.parametrize('restrict', list(RESTRICTIONS))
+def test_prev_pages(table, restrict):
+	restrict_by = RESTRICTIONS[restrict]
+	seen, csk = page(table, CSearchKey.make_cursor(1e9, 'prev'), restrict_by, count=7)
+	assert csk.at_end
+	while not csk.at_start:
+		keys, csk = page(table, csk.prev_cursor, restrict_by, count=7)
+		assert len(keys) > 0
+		seen[:0] = keys
+	assert seen == matching(table, restrict_by)
+
+
+def test_page_past_the_end_is_empty(table):
+	keys, csk = page(table, CSearchKey.make_cursor(398.0, 'next'), [])
+	assert keys == []
+	keys, csk = page(table, CSearchKey.make_cursor(0.0, 'prev'), [])
+	assert keys == []
+
+
+def test_bad_cursor_is_ignored(table):
+	keys, csk = page(table, 'garbage', [])
+	assert csk.cursor is None
+	assert keys == [float(i) for i in range(0, 20, 2)]
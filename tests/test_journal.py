@@ -0,0 +1,60 @@
+import pytest
+
+
+def fill(table):
+	table.insert_many([{'ts': float(i), 'v': i} for i in range(100)])
+	table.db_update({'ts': 1.0, 'w': 1})
+	table.update_many([{'ts': 2.0, 'w': 2}, {'ts': 3.0, 'v': 33}])
+	table.db_delete({'ts': 4.0})
+	table.delete_before(10.0)
+	table.db_insert({'ts': 5.0, 'v': 'back'})
+
+
+def check(table):
+	assert len(table) == 91
+	assert table.get('ts', '==', 5.0) == {'ts': 5.0, 'v': 'back'}
+	assert table.get('ts', '==', 1.0) is None
+	assert table.get('ts', '==', 10.0) == {'ts': 10.0, 'v': 10}
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_replay_after_crash(open_db, loop, tmp_path, write_behind):
+	""" the db is not closed, the journal has every change, and a torn last entry """
+	db = open_db(journal_fsync=0, write_behind=write_behind)
+	fill(db.table('P', 'ts'))
+	loop.run_until_complete(db.caught_up())
+	with open(str(tmp_path / 'steamlink.db.journal'), 'a') as f:
+		f.write('{"t":"P","f":"ts","k":99.0,"op":"del"')
+	open_db.crash(db)
+
+	check(open_db(journal_fsync=0).table('P', 'ts'))
+
+
+def test_partial_updates_merge_on_replay(open_db):
+	db = open_db(journal_fsync=0)
+	table = db.table('P', 'ts')
+	table.db_insert({'ts': 1.0, 'a': 1, 'b': 1})
+	table.db_update({'ts': 1.0, 'b': 2})
+	table.db_update({'ts': 1.0, 'c': 3})
+	open_db.crash(db)
+
+	assert open_db(journal_fsync=0).table('P', 'ts').get('ts', '==', 1.0) == {'ts': 1.0, 'a': 1, 'b': 2, 'c': 3}
+
+
+def test_replay_then_checkpoint(open_db):
+	""" a replayed journal is compacted into the db file, later changes journal on top of it """
+	db = open_db(journal_fsync=0)
+	fill(db.table('P', 'ts'))
+	open_db.crash(db)
+
+	db = open_db(journal_fsync=0)
+	table = db.table('P', 'ts')
+	check(table)
+	table.db_insert({'ts': 200.0, 'v': 200})
+	db.close()
+
+	table = open_db().table('P', 'ts')
+	assert len(table) == 92
+	assert table.get('ts', '==', 200.0) == {'ts': 200.0, 'v': 200}
+	assert table.get('ts', '==', 2.0) is None
+	assert table.get('ts', '==', 50.0) == {'ts': 50.0, 'v': 50}
@@ -0,0 +1,67 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from steamlink.lazytable import LazyTable
+from steamlink.linkage import CSearchKey
+from steamlink.query import Query
+
+
+@pytest.fixture
+def loading():
+	""" a LazyTable whose load has not completed, with writes queued since """
+	table = LazyTable('P', 'ts', Future())
+	now = time.time()
+	table.db_insert({'ts': now + 1, 'v': 1})
+	table.insert_many([{'ts': now + 2, 'v': 2}, {'ts': now + 3, 'v': 3}])
+	table.db_update({'ts': now + 2, 'w': 2})
+	table.db_delete({'ts': now + 3})
+	table.now = now
+	return table
+
+
+@pytest.fixture
+def loaded_table(open_db):
+	""" loaded_table(recs) is a table as a completed load gives it """
+	def loaded_table(recs):
+		table = open_db().table('P', 'ts')
+		table.insert_many(recs)
+		return table
+	return loaded_table
+
+
+def test_reads_do_not_wait(loading):
+	now = loading.now
+	t = time.time()
+	assert not loading.ready()
+	assert loading.get('ts', '==', now + 2) == {'ts': now + 2, 'v': 2, 'w': 2}
+	assert loading.get('ts', '==', now + 3) is None
+	assert loading.get('ts', '==', 5.0) is None
+	assert [rec['v'] for rec in loading.search('v', '>', 0)] == [1, 2]
+	assert loading.aggregate(Query.where('v', '>', 0), [('count', None), ('sum', 'v')]) == [{'count': 2, 'sum_v': 3}]
+	assert list(loading.get_range(CSearchKey('P', 'ts', None, 0, 10))) == []
+	assert loading.key_at(1) == now + 2
+	assert loading.key_at(2) is None
+	assert loading.size_bytes() == 0
+	assert len(loading) == 3  # approximate: inserts are counted, deletes are not
+	assert time.time() - t < 0.5
+
+
+def test_queued_writes_applied_after_load(loading, loaded_table):
+	now = loading.now
+	assert loading.delete_before(now + 1, inclusive=True) == 0
+	assert loading.get('ts', '==', now + 1) is None
+
+	loading.future.set_result(loaded_table([{'ts': 1.0, 'v': 0}, {'ts': now + 10, 'v': 10}]))
+	assert loading.ready()
+	assert sorted(rec['ts'] for rec in loading.search('ts', '>', 0)) == [now + 2, now + 10]
+	assert loading.get('ts', '==', now + 2) == {'ts': now + 2, 'v': 2, 'w': 2}
+	assert len(loading) == 2
+
+
+def test_close_waits_for_load(loading, loaded_table):
+	threading.Timer(0.1, loading.future.set_result, [loaded_table([])]).start()
+	loading.close()
+	assert len(loading) == 2
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from steamlink import linkage
+from steamlink.linkage import CSearchKey, DbBackedTable, Item
+from steamlink.retention import Retention
+
+
+class P(Item):
+	keyfield = 'ts'
+	archive_columns = [('ts', 'd'), ('v', 'q')]
+	archive_side = ['s']
+
+	def __init__(self, ts=None):
+		super().__init__(ts)
+
+
+@pytest.fixture(params=[False, True], ids=['direct', 'write_behind'])
+def table(request, open_db):
+	""" table P with 100 records, one a second, the newest now """
+	db = open_db(write_behind=request.param)
+	linkage.Attach(None, db)
+	P._table = DbBackedTable(P, keyfield='ts', tablename='P')
+	now = time.time()
+	P._table.dbtable.insert_many([{'ts': now - 99 + i, 'v': i, 's': str(i)} for i in range(100)])
+	P._table.now = now
+	P._table.db = db
+	return P._table
+
+
+def runs(loop, retention, table, limits):
+	""" the rows reclaimed by each run until there is nothing left to do """
+	res = []
+	while True:
+		rows, _ = loop.run_until_complete(retention.apply('P', table, limits))
+		if rows == 0:
+			return res
+		res.append(rows)
+
+
+def test_no_tables_by_default(loop, table):
+	r = Retention({}, db=table.db)
+	assert loop.run_until_complete(r.run()) is None
+	assert len(table) == 100
+
+
+def test_max_age_in_batches(loop, table):
+	r = Retention({'batch': 30}, db=table.db)
+	assert runs(loop, r, table, {'max_age': 29.5}) == [30, 30, 10]
+	assert len(table) == 30
+	assert r.status()['P']['rows'] == 70
+
+
+def test_max_rows_in_batches(loop, table):
+	r = Retention({'batch': 30}, db=table.db)
+	assert runs(loop, r, table, {'max_rows': 25}) == [30, 30, 15]
+	assert len(table) == 25
+	assert table.dbtable.key_at(0) == table.now - 24
+
+
+def test_no_batch_limit(loop, table):
+	r = Retention({'batch': 0}, db=table.db)
+	assert runs(loop, r, table, {'max_rows': 25}) == [75]
+
+
+def test_archive(loop, table, tmp_path):
+	r = Retention({'batch': 30, 'archive_dir': str(tmp_path / 'archive')}, db=table.db)
+	assert runs(loop, r, table, {'max_rows': 40, 'archive': True}) == [30, 30]
+	assert table.archive is r.archives['P']
+	assert len(table.archive) == 60
+	assert table.archive.records(0, 1) == [{'ts': table.now - 99, 'v': 0, 's': '0'}]
+
+	# cursor pages go on from the table into the archive
+	csk = CSearchKey('P', 'ts', None, 0, 50, cursor=CSearchKey.make_cursor(1e12, 'prev'))
+	assert [item.v for item in table.get_range(csk)] == list(range(50, 100))
+	csk = CSearchKey('P', 'ts', None, 0, 50, cursor=csk.prev_cursor)
+	assert [item.v for item in table.get_range(csk)] == list(range(0, 50))
+	assert csk.at_start and csk.total_item_count == 100
@@ -0,0 +1,61 @@
+import pytest
+
+from steamlink.linkage import CSearchKey
+from steamlink.seglog import SegLogTable
+
+
+def keys(table, start_key=None, count=100):
+	return [rec['ts'] for rec in table.get_range(CSearchKey('P', 'ts', start_key, 0, count))]
+
+
+@pytest.fixture(params=[0, 9], ids=['plain', 'compressed'])
+def table(request, tmp_path):
+	""" keys 1..6 in segments of 3 records, then the late key 2.5 """
+	table = SegLogTable(str(tmp_path), 'P', 'ts', 3, compress_level=request.param)
+	for k in range(1, 7):
+		table.db_insert({'ts': float(k), 'v': k})
+	table.db_insert({'ts': 2.5, 'v': 0})
+	yield table
+	table.close()
+
+
+def reopen(table):
+	table.close()
+	return SegLogTable(table.dirname, 'P', 'ts', 3, compress_level=table.compress_level)
+
+
+def test_late_key_in_order(table):
+	assert keys(table) == [1.0, 2.0, 2.5, 3.0, 4.0, 5.0, 6.0]
+	assert keys(table, start_key=3.0) == [3.0, 4.0, 5.0, 6.0]
+	assert keys(table, start_key=2.1, count=2) == [2.5, 3.0]
+	assert table.key_at(2) == 2.5
+
+
+def test_delete_before_late_key(table):
+	assert table.delete_before(3.0) == 3
+	assert keys(table) == [3.0, 4.0, 5.0, 6.0]
+	assert keys(reopen(table)) == [3.0, 4.0, 5.0, 6.0]
+
+
+def test_duplicate_key_rejected(table):
+	table.db_insert({'ts': 4.0, 'v': 9})
+	table.insert_many([{'ts': 2.5, 'v': 9}, {'ts': 7.0, 'v': 7}])
+	assert len(table) == 8
+	assert table.get('ts', '==', 4.0)['v'] == 4
+	assert table.get('ts', '==', 2.5)['v'] == 0
+
+
+def test_update_stays_in_segment(table):
+	seg, i = table.locate(2.0)
+	table.db_update({'ts': 2.0, 'w': 1})
+	table.update_many([{'ts': 5.0, 'w': 5}])
+	assert table.locate(2.0)[0] is seg
+	assert table.get('ts', '==', 2.0) == {'ts': 2.0, 'v': 2, 'w': 1}
+	assert keys(table) == [1.0, 2.0, 2.5, 3.0, 4.0, 5.0, 6.0]
+
+	table = reopen(table)
+	assert len(table) == 7
+	assert table.get('ts', '==', 2.0) == {'ts': 2.0, 'v': 2, 'w': 1}
+	assert table.get('ts', '==', 5.0) == {'ts': 5.0, 'v': 5, 'w': 5}
+	table.db_delete({'ts': 5.0})
+	assert keys(reopen(table)) == [1.0, 2.0, 2.5, 3.0, 4.0, 6.0]